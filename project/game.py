@@ -21,6 +21,8 @@
 # For more info, see http://inst.eecs.berkeley.edu/~cs188/sp09/pacman.html
 
 from util import *
+from itertools import compress
+import numpy as np
 import time
 import os
 import traceback
@@ -71,11 +73,46 @@ class Configuration:
 
     The convention for positions, like a graph, is that (0,0) is the lower left corner, x increases
     horizontally and y increases vertically.  Therefore, north is the direction of increasing y, or (0,1).
+
+    Configurations are immutable.  Configuration.get returns the one shared
+    instance for a (position, direction) pair, and generateSuccessor
+    remembers its results, so search creates no new configurations once the
+    reachable ones have been seen.
+
+    Agents move in whole or half cells, so the rules work on halfPos, the
+    position in integer half-cell units, and on cell, the nearest grid
+    point; both are exact.  pos keeps the usual (possibly float) coordinates.
     """
 
+    __slots__ = ("pos", "direction", "halfPos", "cell", "_successors")
+
+    _interned = {}
+
     def __init__(self, pos, direction):
-        self.pos = pos
-        self.direction = direction
+        x, y = pos
+        hx, hy = int(round(2 * x)), int(round(2 * y))
+        object.__setattr__(self, "pos", pos)
+        object.__setattr__(self, "direction", direction)
+        object.__setattr__(self, "halfPos", (hx, hy))
+        object.__setattr__(self, "cell", ((hx + 1) >> 1, (hy + 1) >> 1))
+        object.__setattr__(self, "_successors", {})
+
+    def get(pos, direction):
+        "Returns the shared configuration at pos facing direction"
+        key = (pos, direction)
+        configuration = Configuration._interned.get(key)
+        if configuration is None:
+            configuration = Configuration(pos, direction)
+            Configuration._interned[key] = configuration
+        return configuration
+
+    get = staticmethod(get)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Configurations are immutable; use Configuration.get")
+
+    def __reduce__(self):
+        return (Configuration.get, (self.pos, self.direction))
 
     def getPosition(self):
         return self.pos
@@ -84,11 +121,13 @@ class Configuration:
         return self.direction
 
     def isInteger(self):
-        x, y = self.pos
-        return x == int(x) and y == int(y)
+        hx, hy = self.halfPos
+        return not (hx & 1 or hy & 1)
 
     def __eq__(self, other):
-        if other == None:
+        if self is other:
+            return True
+        if other is None:
             return False
         return self.pos == other.pos and self.direction == other.direction
 
@@ -108,12 +147,16 @@ class Configuration:
 
         Actions are movement vectors.
         """
-        x, y = self.pos
-        dx, dy = vector
-        direction = Actions.vectorToDirection(vector)
-        if direction == Directions.STOP:
-            direction = self.direction  # There is no stop direction
-        return Configuration((x + dx, y + dy), direction)
+        successor = self._successors.get(vector)
+        if successor is None:
+            x, y = self.pos
+            dx, dy = vector
+            direction = Actions.vectorToDirection(vector)
+            if direction == Directions.STOP:
+                direction = self.direction  # There is no stop direction
+            successor = Configuration.get((x + dx, y + dy), direction)
+            self._successors[vector] = successor
+        return successor
 
 
 class AgentState:
@@ -121,6 +164,15 @@ class AgentState:
     AgentStates hold the state of an agent (configuration, speed, scared, etc).
     """
 
+    __slots__ = (
+        "start",
+        "configuration",
+        "isPacman",
+        "scaredTimer",
+        "numCarrying",
+        "numReturned",
+    )
+
     def __init__(self, startConfiguration, isPacman):
         self.start = startConfiguration
         self.configuration = startConfiguration
@@ -137,7 +189,9 @@ class AgentState:
             return "Ghost: " + str(self.configuration)
 
     def __eq__(self, other):
-        if other == None:
+        if self is other:
+            return True
+        if other is None:
             return False
         return (
             self.configuration == other.configuration
@@ -166,9 +220,13 @@ class AgentState:
 
 class Grid:
     """
-    A 2-dimensional array of objects backed by a list of lists.  Data is accessed
-    via grid[x][y] where (x,y) are positions on a Pacman map with x horizontal,
-    y vertical and the origin (0,0) in the bottom left corner.
+    A 2-dimensional array of booleans packed into the bits of one integer.  Data
+    is accessed via grid[x][y] where (x,y) are positions on a Pacman map with x
+    horizontal, y vertical and the origin (0,0) in the bottom left corner.
+
+    Cell (x,y) is bit x * height + y.  Python integers are immutable, so copies
+    share their bits until one of them is written to, which makes copy O(1).
+    A frozen grid (see freeze) refuses writes; its copies are writable.
 
     The __str__ method constructs an output that is oriented like a pacman board.
     """
@@ -180,19 +238,38 @@ class Grid:
 
         self.width = width
         self.height = height
-        self.data = [[initialValue for y in range(height)] for x in range(width)]
+        self.bits = (1 << (width * height)) - 1 if initialValue else 0
+        self._columns = None
+        self.frozen = False
         if bitRepresentation:
             self._unpackBits(bitRepresentation)
 
     def __getitem__(self, i):
-        return self.data[i]
+        if isinstance(i, slice):
+            return [self[x] for x in range(*i.indices(self.width))]
+        columns = self._columns
+        if columns is None:
+            columns = self._columns = [None] * self.width
+        column = columns[i]
+        if column is None:
+            # Copies are cheap, so only build the views that are used
+            column = columns[i] = GridColumn(self, i % self.width)
+        return column
 
     def __setitem__(self, key, item):
-        self.data[key] = item
+        column = self[key]
+        for y in range(self.height):
+            column[y] = item[y]
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __len__(self):
+        return self.width
 
     def __str__(self):
         out = [
-            [str(self.data[x][y])[0] for x in range(self.width)]
+            [str(self[x][y])[0] for x in range(self.width)]
             for y in range(self.height)
         ]
         out.reverse()
@@ -201,42 +278,56 @@ class Grid:
     def __eq__(self, other):
         if other == None:
             return False
-        return self.data == other.data
+        return (
+            self.bits == other.bits
+            and self.width == other.width
+            and self.height == other.height
+        )
 
     def __hash__(self):
-        # return hash(str(self))
-        base = 1
-        h = 0
-        for l in self.data:
-            for i in l:
-                if i:
-                    h += base
-                base *= 2
-        return hash(h)
+        return hash(self.bits)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_columns"] = None  # Views are rebuilt on demand
+        return state
+
+    @property
+    def data(self):
+        "A list-of-lists copy of the cells, indexed [x][y]"
+        return [list(column) for column in self]
 
     def copy(self):
         g = Grid(self.width, self.height)
-        g.data = [x[:] for x in self.data]
+        g.bits = self.bits
         return g
 
     def deepCopy(self):
         return self.copy()
 
+    def freeze(self):
+        "Makes the grid read-only, so it can be shared safely"
+        self.frozen = True
+
     def shallowCopy(self):
-        g = Grid(self.width, self.height)
-        g.data = self.data
-        return g
+        # Writes replace self.bits, so a shared grid sees them exactly as a
+        # grid sharing the old list-of-lists would have.
+        return self
 
     def count(self, item=True):
-        return sum([x.count(item) for x in self.data])
+        n = bin(self.bits).count("1")
+        if item:
+            return n
+        return self.width * self.height - n
 
     def asList(self, key=True):
-        list = []
-        for x in range(self.width):
-            for y in range(self.height):
-                if self[x][y] == key:
-                    list.append((x, y))
-        return list
+        bits = self.bits
+        if not key:
+            bits ^= (1 << (self.width * self.height)) - 1
+        # Reverse the binary digits so that string index i is cell i, then let
+        # compress pick out the positions of the set bits in C.
+        flags = bin(bits)[:1:-1].encode().translate(_BIT_FLAGS)
+        return list(compress(_cellPositions(self.width, self.height), flags))
 
     def packBits(self):
         """
@@ -245,20 +336,30 @@ class Grid:
         (width, height, bitPackedInts...)
         """
         bits = [self.width, self.height]
-        currentInt = 0
-        for i in range(self.height * self.width):
-            bit = self.CELLS_PER_INT - (i % self.CELLS_PER_INT) - 1
-            x, y = self._cellIndexToPosition(i)
-            if self[x][y]:
-                currentInt += 2**bit
-            if (i + 1) % self.CELLS_PER_INT == 0:
-                bits.append(currentInt)
-                currentInt = 0
-        bits.append(currentInt)
+        chunkMask = (1 << self.CELLS_PER_INT) - 1
+        for i in range(self.height * self.width // self.CELLS_PER_INT + 1):
+            # The first cell of each chunk goes in the most significant bit
+            chunk = (self.bits >> (i * self.CELLS_PER_INT)) & chunkMask
+            bits.append(int(format(chunk, "0%db" % self.CELLS_PER_INT)[::-1], 2))
         return tuple(bits)
 
+    def toBytes(self):
+        "Returns the cells as little-endian bytes, cell index i being bit i"
+        return self.bits.to_bytes((self.width * self.height + 7) // 8, "little")
+
+    def fromBytes(width, height, buffer):
+        """
+        Builds a width x height grid from the output of toBytes.  buffer may be
+        any bytes-like object, such as a slice of a memoryview.
+        """
+        grid = Grid(width, height)
+        grid.bits = int.from_bytes(buffer, "little")
+        return grid
+
+    fromBytes = staticmethod(fromBytes)
+
     def _cellIndexToPosition(self, index):
-        x = index / self.height
+        x = index // self.height
         y = index % self.height
         return x, y
 
@@ -266,27 +367,68 @@ class Grid:
         """
         Fills in data from a bit-level representation
         """
-        cell = 0
-        for packed in bits:
-            for bit in self._unpackInt(packed, self.CELLS_PER_INT):
-                if cell == self.width * self.height:
-                    break
-                x, y = self._cellIndexToPosition(cell)
-                self[x][y] = bit
-                cell += 1
-
-    def _unpackInt(self, packed, size):
-        bools = []
-        if packed < 0:
-            raise ValueError("must be a positive integer")
-        for i in range(size):
-            n = 2 ** (self.CELLS_PER_INT - i - 1)
-            if packed >= n:
-                bools.append(True)
-                packed -= n
-            else:
-                bools.append(False)
-        return bools
+        value = 0
+        for i, packed in enumerate(bits):
+            if packed < 0:
+                raise ValueError("must be a positive integer")
+            chunk = int(format(packed, "0%db" % self.CELLS_PER_INT)[::-1], 2)
+            value |= chunk << (i * self.CELLS_PER_INT)
+        self.bits = value & ((1 << (self.width * self.height)) - 1)
+
+
+class GridColumn:
+    """
+    A view of column x of a Grid, so that grid[x][y] reads and writes the
+    grid's bits.
+    """
+
+    def __init__(self, grid, x):
+        self.grid = grid
+        self.x = x
+        self.offset = x * grid.height
+
+    def __getitem__(self, y):
+        if y < 0:
+            y += self.grid.height
+        if not 0 <= y < self.grid.height:
+            raise IndexError("grid column index out of range")
+        return (self.grid.bits >> (self.offset + y)) & 1 == 1
+
+    def __setitem__(self, y, value):
+        if y < 0:
+            y += self.grid.height
+        if not 0 <= y < self.grid.height:
+            raise IndexError("grid column index out of range")
+        if value not in [False, True]:
+            raise Exception("Grids can only contain booleans")
+        if self.grid.frozen:
+            raise Exception("This grid is read-only; write to a copy of it")
+        if value:
+            self.grid.bits |= 1 << (self.offset + y)
+        else:
+            self.grid.bits &= ~(1 << (self.offset + y))
+
+    def __len__(self):
+        return self.grid.height
+
+    def __iter__(self):
+        bits = self.grid.bits >> self.offset
+        return iter([(bits >> y) & 1 == 1 for y in range(self.grid.height)])
+
+    def count(self, item=True):
+        return list(self).count(item)
+
+
+_BIT_FLAGS = bytes.maketrans(b"01", b"\0\1")
+_CELL_POSITIONS = {}
+
+
+def _cellPositions(width, height):
+    "Returns the (x,y) position of every cell index of a width x height grid"
+    key = (width, height)
+    if key not in _CELL_POSITIONS:
+        _CELL_POSITIONS[key] = [(x, y) for x in range(width) for y in range(height)]
+    return _CELL_POSITIONS[key]
 
 
 def reconstituteGrid(bitRep):
@@ -323,8 +465,6 @@ class Actions:
         ("South", (0, -1)),
     ]
 
-    TOLERANCE = 0.001
-
     def reverseDirection(action):
         if action == Directions.NORTH:
             return Directions.SOUTH
@@ -360,12 +500,11 @@ class Actions:
 
     def getPossibleActions(config, walls):
         possible = []
-        x, y = config.pos
-        x_int, y_int = int(x + 0.5), int(y + 0.5)
 
         # In between grid points, all agents must continue straight
-        if abs(x - x_int) + abs(y - y_int) > Actions.TOLERANCE:
+        if not config.isInteger():
             return [config.getDirection()]
+        x_int, y_int = config.cell
 
         for dir, vec in Actions._directionsAsList:
             dx, dy = vec
@@ -404,18 +543,127 @@ class Actions:
     getSuccessor = staticmethod(getSuccessor)
 
 
+class Zobrist:
+    """
+    Random keys for the pieces of a game state.  XOR-ing together the keys of
+    every agent, food pellet and capsule gives a hash that can be updated in
+    O(1) when one piece changes.
+
+    Keys are derived from the piece itself rather than drawn from a random
+    generator, so every process agrees on them.  They are 61 bits wide, which
+    Python's hash() passes through unchanged.
+    """
+
+    _keys = {}
+    _directionCodes = {
+        Directions.NORTH: 0,
+        Directions.SOUTH: 1,
+        Directions.EAST: 2,
+        Directions.WEST: 3,
+        Directions.STOP: 4,
+    }
+
+    POSITION = 0
+    DIRECTION = 1
+    TIMER = 2
+    FOOD = 3
+    CAPSULE = 4
+
+    def key(kind, index, a, b):
+        """
+        Returns the key of one piece, described by two small non-negative
+        integers (a cell, a position in half cells, a timer...).
+        """
+        cacheKey = (kind, index, a, b)
+        value = Zobrist._keys.get(cacheKey)
+        if value is None:
+            n = (((kind * 256 + index) * 65536 + a) * 65536) + b
+            # splitmix64 finalizer
+            n = (n + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            n = ((n ^ (n >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+            n = ((n ^ (n >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+            value = (n ^ (n >> 31)) & 0x1FFFFFFFFFFFFFFF
+            Zobrist._keys[cacheKey] = value
+        return value
+
+    key = staticmethod(key)
+
+    def agentKey(index, agentState):
+        return Zobrist.configurationKey(index, agentState.configuration, agentState.scaredTimer)
+
+    agentKey = staticmethod(agentKey)
+
+    def configurationKey(index, configuration, scaredTimer):
+        hx, hy = configuration.halfPos
+        return (
+            Zobrist.key(Zobrist.POSITION, index, hx, hy)
+            ^ Zobrist.directionKey(index, configuration.direction)
+            ^ Zobrist.key(Zobrist.TIMER, index, scaredTimer, 0)
+        )
+
+    configurationKey = staticmethod(configurationKey)
+
+    def directionKey(index, direction):
+        return Zobrist.key(Zobrist.DIRECTION, index, Zobrist._directionCodes[direction], 0)
+
+    directionKey = staticmethod(directionKey)
+
+    def foodKey(position):
+        x, y = position
+        return Zobrist.key(Zobrist.FOOD, 0, x, y)
+
+    foodKey = staticmethod(foodKey)
+
+    def capsuleKey(position):
+        x, y = position
+        return Zobrist.key(Zobrist.CAPSULE, 0, x, y)
+
+    capsuleKey = staticmethod(capsuleKey)
+
+
 class GameStateData:
+    __slots__ = (
+        "food",
+        "capsules",
+        "agentStates",
+        "_ownedAgents",
+        "layout",
+        "_eaten",
+        "score",
+        "_hash",
+        "_numFood",
+        "_foodPositions",
+        "_foodArray",
+        "_foodEaten",
+        "_foodAdded",
+        "_capsuleEaten",
+        "_agentMoved",
+        "_lose",
+        "_win",
+        "scoreChange",
+    )
+
     def __init__(self, prevState=None):
         """
         Generates a new data packet by copying information from its predecessor.
+
+        The agent states are shared with the predecessor until one of the two
+        changes them (see getMutableAgentState), and the capsules are a shared
+        tuple.
         """
         if prevState != None:
             self.food = prevState.food.shallowCopy()
-            self.capsules = prevState.capsules[:]
-            self.agentStates = self.copyAgentStates(prevState.agentStates)
+            self.capsules = prevState.capsules
+            self.agentStates = list(prevState.agentStates)
+            self._ownedAgents = 0
+            prevState._ownedAgents = 0
             self.layout = prevState.layout
             self._eaten = prevState._eaten
             self.score = prevState.score
+            self._hash = prevState._hash
+            self._numFood = prevState._numFood
+            self._foodPositions = prevState._foodPositions
+            self._foodArray = prevState._foodArray
 
         self._foodEaten = None
         self._foodAdded = None
@@ -426,9 +674,15 @@ class GameStateData:
         self.scoreChange = 0
 
     def deepCopy(self):
+        """
+        Copies the parts of the state that can change (agents, food, capsules
+        and score), for example to hand an observation to an agent.  The
+        layout is immutable and shared.
+        """
         state = GameStateData(self)
         state.food = self.food.deepCopy()
-        state.layout = self.layout.deepCopy()
+        state.agentStates = self.copyAgentStates(self.agentStates)
+        state._ownedAgents = (1 << len(state.agentStates)) - 1
         state._agentMoved = self._agentMoved
         state._foodEaten = self._foodEaten
         state._foodAdded = self._foodAdded
@@ -441,6 +695,17 @@ class GameStateData:
             copiedStates.append(agentState.copy())
         return copiedStates
 
+    def getMutableAgentState(self, index):
+        """
+        Returns the state of agent index for editing, first copying it if it
+        may be shared with the state this one was made from, or with one made
+        from it.
+        """
+        if not (self._ownedAgents >> index) & 1:
+            self.agentStates[index] = self.agentStates[index].copy()
+            self._ownedAgents |= 1 << index
+        return self.agentStates[index]
+
     def __eq__(self, other):
         """
         Allows two states to be compared.
@@ -461,26 +726,69 @@ class GameStateData:
     def __hash__(self):
         """
         Allows states to be keys of dictionaries.
+
+        The Zobrist hash is kept up to date by GameState.generateSuccessor, so
+        this is O(1).  Code that edits the data directly should call rehash.
         """
-        for i, state in enumerate(self.agentStates):
-            try:
-                int(hash(state))
-            except TypeError as e:
-                print(e)
-                # hash(state)
-        return int(
-            (
-                hash(tuple(self.agentStates))
-                + 13 * hash(self.food)
-                + 113 * hash(tuple(self.capsules))
-                + 7 * hash(self.score)
-            )
-            % 1048575
-        )
+        return self._hash
+
+    def getFoodPositions(self):
+        """
+        Returns a tuple of the remaining food positions.  It is built once and
+        then shared with successors, which only rebuild it when a pellet is
+        eaten.
+        """
+        if self._foodPositions is None:
+            self._foodPositions = tuple(self.food.asList())
+        return self._foodPositions
+
+    def getFoodArray(self):
+        """
+        Returns the remaining food positions as an n x 2 integer array, shared
+        with successors in the same way as getFoodPositions.  The array is
+        read-only, so no holder of it can change the others' food.
+        """
+        if self._foodArray is None:
+            positions = self.getFoodPositions()
+            food = np.array(positions, dtype=np.intp).reshape(len(positions), 2)
+            food.flags.writeable = False
+            self._foodArray = food
+        return self._foodArray
+
+    def removeFood(self, position):
+        """
+        Clears the pellet at position, keeping the food count, positions and
+        array in step with the grid.
+        """
+        x, y = position
+        self.food = self.food.copy()
+        self.food[x][y] = False
+        self._numFood -= 1
+        if self._foodPositions is not None:
+            i = self._foodPositions.index(position)
+            self._foodPositions = self._foodPositions[:i] + self._foodPositions[i + 1 :]
+        if self._foodArray is not None:
+            food = self._foodArray[(self._foodArray[:, 0] != x) | (self._foodArray[:, 1] != y)]
+            food.flags.writeable = False
+            self._foodArray = food
+
+    def rehash(self):
+        """
+        Recomputes the Zobrist hash from scratch.
+        """
+        h = 0
+        for index, agentState in enumerate(self.agentStates):
+            h ^= Zobrist.agentKey(index, agentState)
+        for position in self.food.asList():
+            h ^= Zobrist.foodKey(position)
+        for position in self.capsules:
+            h ^= Zobrist.capsuleKey(position)
+        self._hash = h
 
     def __str__(self):
         width, height = self.layout.width, self.layout.height
-        map = Grid(width, height)
+        # Grids only hold booleans, so draw the characters into a list of lists
+        map = [[" " for y in range(height)] for x in range(width)]
         if type(self.food) == type((1, 2)):
             self.food = reconstituteGrid(self.food)
         for x in range(width):
@@ -493,7 +801,7 @@ class GameStateData:
                 continue
             if agentState.configuration == None:
                 continue
-            x, y = [int(i) for i in nearestPoint(agentState.configuration.pos)]
+            x, y = agentState.configuration.cell
             agent_dir = agentState.configuration.direction
             if agentState.isPacman:
                 map[x][y] = self._pacStr(agent_dir)
@@ -503,7 +811,9 @@ class GameStateData:
         for x, y in self.capsules:
             map[x][y] = "o"
 
-        return str(map) + ("\nScore: %d\n" % self.score)
+        rows = ["".join([map[x][y] for x in range(width)]) for y in range(height)]
+        rows.reverse()
+        return "\n".join(rows) + ("\nScore: %d\n" % self.score)
 
     def _foodWallStr(self, hasFood, hasWall):
         if hasFood:
@@ -537,8 +847,14 @@ class GameStateData:
         Creates an initial game state from a layout array (see layout.py).
         """
         self.food = layout.food.copy()
+        self._numFood = self.food.count()
+        self._foodPositions = None
+        self._foodArray = None
+        # Build these once here so that removeFood keeps them up to date in
+        # every successor, instead of each leaf rebuilding its own
+        self.getFoodArray()
         # self.capsules = []
-        self.capsules = layout.capsules[:]
+        self.capsules = tuple(layout.capsules)
         self.layout = layout
         self.score = 0
         self.scoreChange = 0
@@ -552,9 +868,11 @@ class GameStateData:
                 else:
                     numGhosts += 1
             self.agentStates.append(
-                AgentState(Configuration(pos, Directions.STOP), isPacman)
+                AgentState(Configuration.get(pos, Directions.STOP), isPacman)
             )
+        self._ownedAgents = (1 << len(self.agentStates)) - 1
         self._eaten = [False for a in self.agentStates]
+        self.rehash()
 
 
 try:
@@ -588,6 +906,7 @@ class Game:
         self.muteAgents = muteAgents
         self.catchExceptions = catchExceptions
         self.moveHistory = []
+        self.recorder = None  # Told about every move, see recording.py
         self.totalAgentTimes = [0 for agent in agents]
         self.totalAgentTimeWarnings = [0 for agent in agents]
         self.agentTimeout = False
@@ -781,7 +1100,9 @@ class Game:
                     self.unmute()
                     return
             else:
+                start_time = time.time()
                 action = agent.getAction(observation)
+                self.totalAgentTimes[agentIndex] += time.time() - start_time
             self.unmute()
 
             # Execute the action
@@ -796,6 +1117,8 @@ class Game:
                     return
             else:
                 self.state = self.state.generateSuccessor(agentIndex, action)
+            if self.recorder is not None:
+                self.recorder.recordMove(agentIndex, action, self.state)
 
             # Change the display
             self.display.update(self.state.data)
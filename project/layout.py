@@ -14,19 +14,64 @@
 
 from util import manhattanDistance
 from game import Grid
+from game import Actions
+from game import Configuration
+from game import Directions
 import os
 import random
+import hashlib
 from functools import reduce
+import numpy as np
 
 VISIBILITY_MATRIX_CACHE = {}
+DISTANCE_MATRIX_CACHE = {}
+SHARED_LAYOUT_CACHE = {}
+
+# Every layout built in this process, by content hash (see getLayoutByHash)
+LAYOUT_REGISTRY = {}
+
+# Directory where distance matrices are saved between runs (None disables it)
+DISTANCE_CACHE_DIR = os.environ.get("PACMAN_DISTANCE_CACHE")
+
+# Stored distance between cells that cannot reach each other
+UNREACHABLE = np.iinfo(np.uint16).max
+
+
+class Corridor:
+    """
+    A run along the maze from `start`, through cells with exactly two open
+    neighbours, to the first junction or dead end (`end`).  actions are the
+    steps taken, cells the cells entered (so end is the last of them) and
+    food the cells among them that held food when the layout was built.
+    """
+
+    __slots__ = ("start", "end", "actions", "cells", "food")
+
+    def __init__(self, start, actions, cells, food):
+        self.start = start
+        self.end = cells[-1]
+        self.actions = actions
+        self.cells = cells
+        self.food = food
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __repr__(self):
+        return "Corridor(%s -> %s, %d steps)" % (self.start, self.end, len(self.actions))
 
 
 class Layout:
     """
     A Layout manages the static information about the game board.
+
+    Layouts are immutable once built: every state of a game (and every game
+    on the same board) shares one, so the walls and food grids are frozen and
+    the capsules and agent positions are tuples.
     """
 
-    def __init__(self, layoutText):
+    def __init__(self, layoutText, name=None):
+        self.name = name
         self.width = len(layoutText[0])
         self.height = len(layoutText)
         self.walls = Grid(self.width, self.height, False)
@@ -35,8 +80,15 @@ class Layout:
         self.agentPositions = []
         self.numGhosts = 0
         self.processLayoutText(layoutText)
-        self.layoutText = layoutText
+        self.layoutText = tuple(layoutText)
+        self.contentHash = hashlib.sha1("\n".join(self.layoutText).encode()).digest()
+        LAYOUT_REGISTRY.setdefault(self.contentHash, self)
         self.totalFood = len(self.food.asList())
+        self.walls.freeze()
+        self.food.freeze()
+        self.capsules = tuple(self.capsules)
+        self.agentPositions = tuple(self.agentPositions)
+        self.initializeActions()
         # self.initializeVisibilityMatrix()
 
     def getNumGhosts(self):
@@ -83,6 +135,259 @@ class Layout:
                 reduce(str.__add__, self.layoutText)
             ]
 
+    def initializeActions(self):
+        """
+        Precomputes the legal actions in every non-wall cell: Pacman's by
+        cell, and the ghosts' by (cell, heading), which already leave out
+        STOP and turning around.  Cells are keyed by their position in half
+        cells (Configuration.halfPos).  The tables hold tuples and are never
+        changed.
+        """
+        self._pacmanActions = {}
+        self._ghostActions = {}
+        for cell in self.walls.asList(False):
+            configuration = Configuration.get(cell, Directions.STOP)
+            self._pacmanActions[configuration.halfPos] = tuple(
+                Actions.getPossibleActions(configuration, self.walls)
+            )
+            for direction in Actions._directions:
+                configuration = Configuration.get(cell, direction)
+                self._ghostActions[(configuration.halfPos, direction)] = self._computeGhostActions(
+                    configuration
+                )
+
+    def _computeGhostActions(self, configuration):
+        "Ghosts cannot stop, and only turn around at a dead end"
+        possibleActions = Actions.getPossibleActions(configuration, self.walls)
+        reverse = Actions.reverseDirection(configuration.direction)
+        if Directions.STOP in possibleActions:
+            possibleActions.remove(Directions.STOP)
+        if reverse in possibleActions and len(possibleActions) > 1:
+            possibleActions.remove(reverse)
+        return tuple(possibleActions)
+
+    def getPacmanActions(self, configuration):
+        """
+        Returns the tuple of actions (including STOP) open to Pacman from
+        configuration.
+        """
+        actions = self._pacmanActions.get(configuration.halfPos)
+        if actions is None:  # Between two cells
+            actions = tuple(Actions.getPossibleActions(configuration, self.walls))
+        return actions
+
+    def getGhostActions(self, configuration):
+        """
+        Returns the tuple of actions open to a ghost from configuration.
+        """
+        key = (configuration.halfPos, configuration.direction)
+        actions = self._ghostActions.get(key)
+        if actions is None:  # Between two cells, as scared ghosts can be
+            actions = self._computeGhostActions(configuration)
+            self._ghostActions[key] = actions
+        return actions
+
+    def initializeJunctions(self):
+        """
+        Builds the junction graph of the maze.  Its nodes, self.junctions, are
+        the non-wall cells that are not plain corridor: those with other than
+        two open neighbours.  self.junctionEdges maps each node to the tuple
+        of Corridors leaving it, one per open direction, which are the edges.
+        A corridor that loops back on itself with no node on it gets one.
+        """
+        self._corridors = {}
+        self.junctions = set()
+        for cell in self.walls.asList(False):
+            if len(self._openDirections(cell)) != 2:
+                self.junctions.add(cell)
+        # Loops without junctions: make their first cell a node
+        seen = set(self.junctions)
+        for cell in self.walls.asList(False):
+            if cell not in seen:
+                corridor = self.getCorridor(cell, self._openDirections(cell)[0])
+                if corridor.end == cell:
+                    self.junctions.add(cell)
+                    self._corridors = {}
+                seen.update(corridor.cells)
+        self.junctionEdges = {}
+        for cell in self.junctions:
+            self.junctionEdges[cell] = tuple(
+                [self.getCorridor(cell, direction) for direction in self._openDirections(cell)]
+            )
+
+    def _openDirections(self, cell):
+        x, y = cell
+        directions = []
+        for direction, (dx, dy) in Actions._directionsAsList:
+            if (dx, dy) != (0, 0) and not self.walls[x + dx][y + dy]:
+                directions.append(direction)
+        return directions
+
+    def getCorridor(self, cell, direction):
+        """
+        Returns the Corridor that starts by stepping from cell (a whole cell)
+        in direction, which must be open, and follows the maze to the next
+        node of the junction graph.  Corridors are built once and kept.
+        """
+        if not hasattr(self, "junctions"):
+            self.initializeJunctions()
+        key = (cell, direction)
+        corridor = self._corridors.get(key)
+        if corridor is None:
+            actions = []
+            cells = []
+            x, y = cell
+            while True:
+                dx, dy = Actions.directionToVector(direction)
+                x, y = x + int(dx), y + int(dy)
+                actions.append(direction)
+                cells.append((x, y))
+                if (x, y) in self.junctions or (x, y) == cell:
+                    break
+                reverse = Actions.reverseDirection(direction)
+                direction = [d for d in self._openDirections((x, y)) if d != reverse][0]
+            food = tuple([c for c in cells if self.food[c[0]][c[1]]])
+            corridor = Corridor(cell, tuple(actions), tuple(cells), food)
+            self._corridors[key] = corridor
+        return corridor
+
+    def initializeDistances(self):
+        """
+        Builds (or fetches from the cache) the shortest path distance between
+        every pair of non-wall cells.
+
+        self.cells lists the non-wall cells, self.cellIndices maps each of
+        them to its row and column in self.distances, a uint16 matrix, and
+        self.cellIndexGrid does the same as a width x height array holding -1
+        on walls.  Matrices are cached per layout text in memory and, if
+        DISTANCE_CACHE_DIR is set, on disk.  Both arrays are shared by every
+        layout with the same text, so they are read-only.
+        """
+        key = "\n".join(self.layoutText)
+        if key not in DISTANCE_MATRIX_CACHE:
+            cells = self.walls.asList(False)
+            cellIndices = dict([(cell, i) for i, cell in enumerate(cells)])
+            cellIndexGrid = np.full((self.width, self.height), -1, dtype=np.intp)
+            for i, (x, y) in enumerate(cells):
+                cellIndexGrid[x, y] = i
+            distances = self._loadDistances(key, len(cells))
+            if distances is None:
+                distances = self._computeDistances(cells, cellIndices)
+                self._saveDistances(key, distances)
+            cellIndexGrid.flags.writeable = False
+            distances.flags.writeable = False
+            DISTANCE_MATRIX_CACHE[key] = (cells, cellIndices, cellIndexGrid, distances)
+        (
+            self.cells,
+            self.cellIndices,
+            self.cellIndexGrid,
+            self.distances,
+        ) = DISTANCE_MATRIX_CACHE[key]
+
+    def _computeDistances(self, cells, cellIndices):
+        "Runs a breadth first search from every cell"
+        neighbors = []
+        for x, y in cells:
+            adjacent = [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
+            neighbors.append([cellIndices[n] for n in adjacent if n in cellIndices])
+
+        distances = np.full((len(cells), len(cells)), UNREACHABLE, dtype=np.uint16)
+        for source in range(len(cells)):
+            row = [UNREACHABLE] * len(cells)
+            row[source] = 0
+            frontier = [source]
+            while frontier:
+                nextFrontier = []
+                for cell in frontier:
+                    d = row[cell] + 1
+                    for n in neighbors[cell]:
+                        if row[n] == UNREACHABLE:
+                            row[n] = d
+                            nextFrontier.append(n)
+                frontier = nextFrontier
+            distances[source] = row
+        return distances
+
+    def _distanceCachePath(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(DISTANCE_CACHE_DIR, "distances-%s.npy" % digest)
+
+    def _loadDistances(self, key, numCells):
+        if DISTANCE_CACHE_DIR is None:
+            return None
+        path = self._distanceCachePath(key)
+        if not os.path.exists(path):
+            return None
+        distances = np.load(path)
+        if distances.shape != (numCells, numCells) or distances.dtype != np.uint16:
+            return None
+        return distances
+
+    def _saveDistances(self, key, distances):
+        if DISTANCE_CACHE_DIR is None:
+            return
+        os.makedirs(DISTANCE_CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so that parallel runs never read a
+        # half-written matrix
+        path = self._distanceCachePath(key)
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpPath, "wb") as f:
+            np.save(f, distances)
+        os.replace(tmpPath, path)
+
+    def mazeDistance(self, pos1, pos2):
+        """
+        Returns the length of the shortest path between two positions that
+        stays off the walls.
+
+        Scared ghosts can stand halfway between two cells; their distance is
+        measured through whichever of the two cells is closer.
+        """
+        if not hasattr(self, "distances"):
+            self.initializeDistances()
+        i = self.cellIndices.get(pos1)
+        j = self.cellIndices.get(pos2)
+        if i is not None and j is not None:
+            d = self.distances.item(i, j)
+            if d == UNREACHABLE:
+                return float("inf")
+            return d
+
+        if pos1 == pos2:
+            return 0
+        best = float("inf")
+        for i, offset1 in self._nearbyCells(pos1):
+            for j, offset2 in self._nearbyCells(pos2):
+                d = self.distances.item(i, j)
+                if d != UNREACHABLE:
+                    best = min(best, d + offset1 + offset2)
+        return best
+
+    def distancesFrom(self, pos):
+        """
+        Returns an array of the maze distance from pos to every cell, indexed
+        like self.cells.  Unreachable cells hold UNREACHABLE.
+        """
+        if not hasattr(self, "distances"):
+            self.initializeDistances()
+        i = self.cellIndices.get(pos)
+        if i is not None:
+            return self.distances[i]
+        rows = [self.distances[i] + offset for i, offset in self._nearbyCells(pos)]
+        return np.minimum.reduce(rows)
+
+    def _nearbyCells(self, pos):
+        "Returns (cell index, distance) for the cells next to a half-step position"
+        x, y = pos
+        xs = [(int(x), 0)] if x == int(x) else [(int(x), x - int(x)), (int(x) + 1, int(x) + 1 - x)]
+        ys = [(int(y), 0)] if y == int(y) else [(int(y), y - int(y)), (int(y) + 1, int(y) + 1 - y)]
+        nearby = []
+        for cx, dx in xs:
+            for cy, dy in ys:
+                if (cx, cy) in self.cellIndices:
+                    nearby.append((self.cellIndices[(cx, cy)], dx + dy))
+        return nearby
+
     def isWall(self, pos):
         x, col = pos
         return self.walls[x][col]
@@ -122,7 +427,13 @@ class Layout:
         return "\n".join(self.layoutText)
 
     def deepCopy(self):
-        return Layout(self.layoutText[:])
+        "Layouts are immutable, so a copy is the layout itself"
+        return self
+
+    def __reduce__(self):
+        # Pickle only the text; the grids and distances are rebuilt (once per
+        # process) on the other side.
+        return (sharedLayout, (self.layoutText, self.name))
 
     def processLayoutText(self, layoutText):
         """
@@ -162,6 +473,26 @@ class Layout:
             self.numGhosts += 1
 
 
+def getLayoutByHash(contentHash):
+    """
+    Returns a layout built in this process whose Layout.contentHash (the
+    SHA-1 digest of its text) is contentHash, or None.
+    """
+    return LAYOUT_REGISTRY.get(contentHash)
+
+
+def sharedLayout(layoutText, name=None):
+    """
+    Returns a Layout for layoutText, reusing the one already built in this
+    process.  Used when unpickling game states, so a worker that receives many
+    states from the same game parses the layout only once.
+    """
+    layoutText = tuple(layoutText)
+    if layoutText not in SHARED_LAYOUT_CACHE:
+        SHARED_LAYOUT_CACHE[layoutText] = Layout(layoutText, name)
+    return SHARED_LAYOUT_CACHE[layoutText]
+
+
 def getLayout(name, back=2):
     if name.endswith(".lay"):
         layout = tryToLoad("layouts/" + name)
@@ -184,6 +515,7 @@ def tryToLoad(fullname):
         return None
     f = open(fullname)
     try:
-        return Layout([line.strip() for line in f])
+        name = os.path.basename(fullname)[: -len(".lay")]
+        return Layout([line.strip() for line in f], name)
     finally:
         f.close()
@@ -1,28 +1,36 @@
 from game import Directions
+from game import Actions
+from game import Zobrist
 import random, util
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 
 from game import Agent
+from layout import UNREACHABLE
 from pacman import GameState
+from pacman import TIME_PENALTY
+import ghostAgents
+
+# Consts of the evaluation functions
+INF = 100000000.0  # Infinite value for being dead
+WEIGHT_FOOD = 5.0  # Food base value
+WEIGHT_GHOST = -5.0  # Ghost base value
+WEIGHT_SCARED_GHOST = 50.0  # Scared ghost base value
 
 
 def scoreEvaluationFunction(currentGameState: GameState):
     newPos = currentGameState.getPacmanPosition()
-    newFood = currentGameState.getFood()
+    newFood = currentGameState.getFoodPositions()
     newGhostStates = currentGameState.getGhostStates()
 
-    # Consts
-    INF = 100000000.0  # Infinite value for being dead
-    WEIGHT_FOOD = 5.0  # Food base value
-    WEIGHT_GHOST = -5.0  # Ghost base value
-    WEIGHT_SCARED_GHOST = 50.0  # Scared ghost base value
-
     # Base on gameState.getScore()
 
     score = currentGameState.getScore()
 
     # Evaluate the distance to the closest food
-    distancesToFoodList = [util.manhattanDistance(newPos, foodPos) for foodPos in newFood.asList()]
+    distancesToFoodList = [currentGameState.getMazeDistance(newPos, foodPos) for foodPos in newFood]
     if len(distancesToFoodList) > 0:
         score += WEIGHT_FOOD / min(distancesToFoodList)
     else:
@@ -30,7 +38,7 @@ def scoreEvaluationFunction(currentGameState: GameState):
 
     # Evaluate the distance to ghosts
     for ghost in newGhostStates:
-        distance = util.manhattanDistance(newPos, ghost.getPosition())
+        distance = currentGameState.getMazeDistance(newPos, ghost.getPosition())
         if distance > 0:
             if ghost.scaredTimer > 0:  # If scared, add points
                 score += WEIGHT_SCARED_GHOST / distance
@@ -42,6 +50,91 @@ def scoreEvaluationFunction(currentGameState: GameState):
     return score
 
 
+def vectorizedEvaluationFunction(currentGameState: GameState):
+    """
+    Computes the same value as scoreEvaluationFunction with NumPy: the food
+    term comes from one row of the layout's distance matrix indexed by the
+    state's food array, and the ghost terms are summed as arrays.
+    """
+    layout = currentGameState.data.layout
+    newPos = currentGameState.getPacmanPosition()
+    newFood = currentGameState.getFoodArray()
+    newGhostStates = currentGameState.getGhostStates()
+
+    score = currentGameState.getScore()
+
+    # Evaluate the distance to the closest food
+    if len(newFood) > 0:
+        distances = layout.distancesFrom(newPos)
+        closest = distances[layout.cellIndexGrid[newFood[:, 0], newFood[:, 1]]].min()
+        if closest < UNREACHABLE:
+            score += WEIGHT_FOOD / closest
+    else:
+        score += WEIGHT_FOOD
+
+    # Evaluate the distance to ghosts
+    if len(newGhostStates) > 0:
+        distances = np.array([layout.mazeDistance(newPos, ghost.getPosition()) for ghost in newGhostStates])
+        if (distances == 0).any():
+            return -INF  # Pacman is dead at this point
+        timers = np.array([ghost.scaredTimer for ghost in newGhostStates])
+        score += (np.where(timers > 0, WEIGHT_SCARED_GHOST, WEIGHT_GHOST) / distances).sum()
+    return float(score)
+
+
+def rolloutEvaluationFunction(currentGameState: GameState):
+    """
+    What a Monte Carlo rollout is worth: the game score, less the distance to
+    the closest food, so that short rollouts that eat nothing still tell
+    Pacman which way the food is.  Unlike the evaluation functions above it
+    has no special value for death, which is already 500 points off the score.
+    """
+    layout = currentGameState.data.layout
+    score = currentGameState.getScore()
+    food = currentGameState.getFoodArray()
+    if len(food) > 0:
+        distances = layout.distancesFrom(currentGameState.getPacmanPosition())
+        closest = distances[layout.cellIndexGrid[food[:, 0], food[:, 1]]].min()
+        if closest < UNREACHABLE:
+            score -= closest
+    return float(score)
+
+
+def scoreEvaluationBounds(gameState, rounds):
+    """
+    Returns (lower, upper) bounds on what scoreEvaluationFunction or
+    vectorizedEvaluationFunction can return for any state reached from
+    gameState within `rounds` rounds of moves.  The upper bound adds up
+    every point that could still be scored: a food and a scared ghost per
+    ghost each round (but only the ghosts scared now if Pacman cannot reach a
+    capsule in time), the win bonus, and the largest food and scared ghost
+    terms.
+    """
+    score = gameState.getScore()
+    numGhosts = gameState.getNumAgents() - 1
+    numFood = gameState.getNumFood()
+    pacmanPosition = gameState.getPacmanPosition()
+    capsuleDistances = [gameState.getMazeDistance(pacmanPosition, c) for c in gameState.getCapsules()]
+    if len(capsuleDistances) > 0 and min(capsuleDistances) <= rounds:
+        scaredGhosts = numGhosts
+        ghostsEaten = numGhosts * rounds
+    else:
+        scaredGhosts = len([g for g in gameState.getGhostStates() if g.scaredTimer > 0])
+        ghostsEaten = scaredGhosts
+    upper = score + 10 * min(rounds, numFood) + 200 * ghostsEaten
+    if numFood <= rounds:
+        upper += 500
+    # Scared ghosts can be half a cell away
+    upper += WEIGHT_FOOD + scaredGhosts * WEIGHT_SCARED_GHOST / 0.5
+    lower = score - rounds - 500 + numGhosts * WEIGHT_GHOST / 0.5
+    return min(lower, -INF), upper
+
+
+def noEvaluationBounds(gameState, rounds):
+    "For evaluation functions without known bounds; turns off Star1 pruning"
+    return float('-inf'), float('inf')
+
+
 def getPossibleActions(gameState, player):
     legalAction = gameState.getLegalActions(player)
     if Directions.STOP in legalAction:
@@ -49,34 +142,381 @@ def getPossibleActions(gameState, player):
     return legalAction
 
 
+def stateKey(gameState):
+    """
+    Returns a compact hashable key for a search position.
+
+    This is the state's Zobrist hash with Pacman's heading taken out, since it
+    does not affect his legal moves, so positions reached through different
+    move orders share a key.  The score is added because the hash ignores it.
+    """
+    data = gameState.data
+    pacmanDirection = data.agentStates[0].configuration.direction
+    return (hash(gameState) ^ Zobrist.directionKey(0, pacmanDirection), data.score)
+
+
+def expectedValue(probabilities, values):
+    "The sum of probability * value; 0 for no values, whatever the values' range"
+    total = 0.0
+    for probability, value in zip(probabilities, values):
+        total += probability * value
+    return total
+
+
+def putFirst(actions, first):
+    "Moves `first` to the front of actions, if it is one of them"
+    if first is not None and first in actions and actions[0] != first:
+        actions.remove(first)
+        actions.insert(0, first)
+    return actions
+
+
+class SearchTimeout(Exception):
+    """Raised inside a search when its wall-clock deadline has passed"""
+    pass
+
+
+class TranspositionTable:
+    """
+    A bounded table of previously searched positions.
+
+    Entries are stored in a fixed number of slots addressed by the hash of
+    their key, so memory stays capped at `size` entries.  When two positions
+    compete for a slot the deeper search is kept, unless the stored entry is
+    left over from an earlier call to newSearch, in which case it is always
+    replaced.
+    """
+
+    EXACT = 0
+    LOWER = 1  # The true value is at least the stored value
+    UPPER = 2  # The true value is at most the stored value
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.slots = [None] * size
+        self.generation = 0
+        self.probes = 0
+        self.hits = 0
+
+    def newSearch(self):
+        "Marks every stored entry as belonging to an older search"
+        self.generation += 1
+
+    def lookup(self, key):
+        """
+        Returns (depth, flag, value, action) for key, or None if the position
+        is not stored.
+        """
+        self.probes += 1
+        entry = self.slots[hash(key) % self.size]
+        if entry is None or entry[0] != key:
+            return None
+        self.hits += 1
+        return entry[1:5]
+
+    def store(self, key, depth, flag, value, action):
+        index = hash(key) % self.size
+        entry = self.slots[index]
+        if entry is None or entry[0] == key or depth >= entry[1] or entry[5] != self.generation:
+            self.slots[index] = (key, depth, flag, value, action, self.generation)
+
+    def clear(self):
+        self.slots = [None] * self.size
+
+
+class MoveOrdering:
+    """
+    Decides the order in which a search node tries its moves.  This base
+    class only puts the transposition table move first; subclasses can learn
+    from the moves that caused cutoffs.
+    """
+
+    def newSearch(self):
+        "Called at the start of every getAction"
+        pass
+
+    def order(self, gameState, player, ply, actions, hint):
+        """
+        Returns actions, best first.  hint is the best move stored for this
+        position in the transposition table, or None.
+        """
+        return putFirst(actions, hint)
+
+    def recordCutoff(self, gameState, player, ply, action, remaining):
+        "Called when action caused a cutoff with `remaining` levels left to search"
+        pass
+
+
+class KillerHistoryOrdering(MoveOrdering):
+    """
+    Tries the transposition table move first, then the killer moves of the
+    ply (the latest moves that caused a cutoff there), then the remaining
+    moves by their history score.  A move's history score grows with the
+    square of the remaining depth each time it causes a cutoff for that
+    agent at that position, and is halved at every new search.
+    """
+
+    def __init__(self, numKillers=2):
+        self.numKillers = numKillers
+        self.killers = {}  # ply -> list of moves, most recent first
+        self.history = {}  # (agent, position, move) -> score
+
+    def newSearch(self):
+        self.killers = {}
+        for key in list(self.history.keys()):
+            self.history[key] //= 2
+            if self.history[key] == 0:
+                del self.history[key]
+
+    def order(self, gameState, player, ply, actions, hint):
+        position = gameState.data.agentStates[player].configuration.pos
+        history = self.history
+        actions.sort(key=lambda a: history.get((player, position, a), 0), reverse=True)
+        for killer in reversed(self.killers.get(ply, ())):
+            putFirst(actions, killer)
+        return putFirst(actions, hint)
+
+    def recordCutoff(self, gameState, player, ply, action, remaining):
+        killers = self.killers.setdefault(ply, [])
+        if action not in killers:
+            killers.insert(0, action)
+            del killers[self.numKillers :]
+        position = gameState.data.agentStates[player].configuration.pos
+        key = (player, position, action)
+        self.history[key] = self.history.get(key, 0) + remaining * remaining
+
+
+# Root moves are searched with alpha this far below the best value so far, so
+# a later move that exactly ties the best one is still searched exactly.
+ROOT_TIE_MARGIN = 1e-9
+
+# The search agent of a root search worker process, see AIAgent.searchRootParallel
+_workerAgent = None
+
+
+def _initSearchWorker(agentClass, agentArgs, sharedAlpha, alphaLock):
+    global _workerAgent
+    _workerAgent = agentClass(**agentArgs)
+    _workerAgent.sharedAlpha = sharedAlpha
+    _workerAgent.alphaLock = alphaLock
+
+
+def _searchRootMove(gameState, action, searchCount, searchDepth, deadline):
+    """
+    Searches one root move in a worker process.  Returns (value, reached the
+    horizon, node counts), or None if the deadline passed first.
+    """
+    agent = _workerAgent
+    if agent.searchCount != searchCount:
+        agent.searchCount = searchCount
+        agent.newSearch()
+    agent.searchDepth = searchDepth
+    agent.deadline = deadline
+    agent.reachedHorizon = False
+    agent.stats = util.Counter()
+    try:
+        value = agent.searchRootMove(gameState, action, agent.sharedAlpha.value)
+    except SearchTimeout:
+        return None
+    agent.raiseSharedAlpha(value - ROOT_TIE_MARGIN)
+    return value, agent.reachedHorizon, agent.stats
+
+
+def isTrue(value):
+    "Reads a boolean agent argument, which arrives as a string (or 1 for a bare flag)"
+    return str(value).lower() in ("1", "true", "yes")
+
+
 class MultiAgentSearchAgent(Agent):
     def __init__(self, evalFn="scoreEvaluationFunction", depth="2", time_limit="6"):
         self.index = 0  # Pacman is always agent index 0
         self.evaluationFunction = util.lookup(evalFn, globals())
         self.depth = int(depth)
-        self.time_limit = int(time_limit)
+        self.time_limit = float(time_limit)
+
+    def setGhostModel(self, name):
+        "For agents that predict the ghosts: name is a GhostAgent class in ghostAgents"
+        self.ghostModel = util.lookup(name, vars(ghostAgents))
+        self.ghostModels = {}
+
+    def getGhostModel(self, index):
+        "The ghost model's instance for ghost `index`"
+        if index not in self.ghostModels:
+            self.ghostModels[index] = self.ghostModel(index)
+        return self.ghostModels[index]
 
 
 class AIAgent(MultiAgentSearchAgent):
+    """
+    Alpha-beta search that remembers the positions it has searched in a
+    transposition table, which is kept between calls to getAction.
+
+    getAction deepens one level at a time until `depth` levels have been
+    searched or `time_limit` seconds have passed, and plays the best root move
+    among those that were completely searched.  depth=0 deepens until the time
+    limit; time_limit=0 disables the deadline.
+
+    Below the root, moves are played and taken back in place on one working
+    state (GameState.applyMove and undoMove) instead of copying it.
+
+    `ordering` names the MoveOrdering class used at every node.  With
+    showStats, the node and cutoff counts are printed at the end of each game.
+
+    With workers > 0 the root moves after the first are searched in parallel
+    by a pool of that many processes, which share the best root value found so
+    far as their alpha bound.
+
+    With predictFarGhosts, a ghost too far away to reach Pacman before the
+    search horizon does not branch: it takes the one move predicted by
+    predictGhostAction.  This changes values only through the evaluation of
+    the far ghosts' positions.
+
+    With macroActions, each of Pacman's moves runs him down a corridor to the
+    next node of the layout's junction graph (Layout.getCorridor), while the
+    ghosts follow predictGhostAction step by step.  The ghosts do not branch,
+    and `depth` counts corridors instead of steps, so the search sees much
+    further for the same number of nodes but treats the ghosts as predicted
+    rather than as adversaries.
+    """
+
+    # The node types counted in stats, as printed by final
+    nodeTypes = ["max", "min"]
+
+    # Whether every node below a root move shares its window, so that a root
+    # search worker may raise alpha anywhere to the bound found by the others
+    sharedAlphaAtNodes = True
+
+    def __init__(
+        self,
+        evalFn="vectorizedEvaluationFunction",
+        depth="2",
+        time_limit="6",
+        ttSize="65536",
+        ordering="KillerHistoryOrdering",
+        showStats="False",
+        workers="0",
+        predictFarGhosts="False",
+        macroActions="False",
+    ):
+        MultiAgentSearchAgent.__init__(self, evalFn, depth, time_limit)
+        if self.depth <= 0 and self.time_limit <= 0:
+            raise Exception("AIAgent needs a positive depth or a positive time_limit")
+        if int(ttSize) < 1:
+            raise Exception("AIAgent needs a ttSize of at least 1")
+        self.transpositionTable = TranspositionTable(int(ttSize))
+        self.ordering = util.lookup(ordering, globals())()
+        self.showStats = isTrue(showStats)
+        self.stats = util.Counter()
+        self.searchDepth = self.depth
+        self.deadline = None
+        self.reachedHorizon = False
+        self.predictFarGhosts = isTrue(predictFarGhosts)
+        self.macroActions = isTrue(macroActions)
+        self.pathSteps = 0  # Pacman's steps from the root, in macroActions mode
+        self.workers = int(workers)
+        self.workerArgs = dict(
+            evalFn=evalFn,
+            ttSize=ttSize,
+            ordering=ordering,
+            predictFarGhosts=predictFarGhosts,
+            macroActions=macroActions,
+        )
+        self.searchCount = 0
+        self.pool = None
+        self.rootAlpha = None
+        self.rootAlphaLock = None
+        # Set in worker processes only
+        self.sharedAlpha = None
+        self.alphaLock = None
+
+    def newSearch(self):
+        "Called at the start of every getAction, and in a worker for each one"
+        if self.macroActions:
+            # Values depend on the root (see evaluate), so none carry over
+            self.transpositionTable.clear()
+        else:
+            self.transpositionTable.newSearch()
+        self.ordering.newSearch()
+
+    def evaluate(self, gameState):
+        """
+        The evaluation of a leaf.  Corridors differ in length, so with
+        macroActions the time penalty of Pacman's steps since the root is
+        given back; otherwise the search would favour short corridors.
+        """
+        value = self.evaluationFunction(gameState)
+        if self.macroActions:
+            value += TIME_PENALTY * self.pathSteps
+        return value
+
     def alphaBeta(self, depth, gameState, player, alpha, beta):
-        if gameState.isWin() or gameState.isLose() or depth == self.depth:
-            return self.evaluationFunction(gameState)
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SearchTimeout()
+        if self.sharedAlpha is not None and self.sharedAlphaAtNodes:
+            # Another worker may have raised the root's bound since we started
+            alpha = max(alpha, self.sharedAlpha.value)
+        if gameState.isWin() or gameState.isLose():
+            return self.evaluate(gameState)
+        if depth == self.searchDepth:
+            self.reachedHorizon = True
+            return self.evaluate(gameState)
+
+        table = self.transpositionTable
+        key = (player, stateKey(gameState))
+        remaining = self.searchDepth - depth
+        entry = table.lookup(key)
+        hint = None
+        if entry is not None:
+            entryDepth, flag, value, hint = entry
+            if entryDepth >= remaining:
+                if flag == TranspositionTable.EXACT:
+                    return value
+                if flag == TranspositionTable.LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
         if player == 0:
-            return self.alphaPart(depth, gameState, player, alpha, beta)
+            value, action = self.alphaPart(depth, gameState, player, alpha, beta, hint)
+        else:
+            value, action = self.betaPart(depth, gameState, player, alpha, beta, hint)
+
+        if value <= alpha:
+            flag = TranspositionTable.UPPER
+        elif value >= beta:
+            flag = TranspositionTable.LOWER
         else:
-            return self.betaPart(depth, gameState, player, alpha, beta)
+            flag = TranspositionTable.EXACT
+        table.store(key, remaining, flag, value, action)
+        return value
 
-    def alphaPart(self, depth, gameState, player, alpha, beta):
+    def alphaPart(self, depth, gameState, player, alpha, beta, hint=None):
+        if self.macroActions:
+            return self.macroPart(depth, gameState, alpha, beta, hint)
         maxValue = float('-inf')
-        legalActions = getPossibleActions(gameState, player)
-        for action in legalActions:
-            maxValue = max(maxValue, self.alphaBeta(depth, gameState.generateSuccessor(player, action), 1, alpha, beta))
+        bestAction = None
+        ply = depth * gameState.getNumAgents() + player
+        legalActions = self.ordering.order(gameState, player, ply, getPossibleActions(gameState, player), hint)
+        for index, action in enumerate(legalActions):
+            gameState.applyMove(player, action, trusted=True)
+            try:
+                value = self.alphaBeta(depth, gameState, 1, alpha, beta)
+            finally:
+                gameState.undoMove()
+            if value > maxValue:
+                maxValue, bestAction = value, action
             if maxValue >= beta:
+                self.recordCutoff(gameState, player, ply, action, depth, index, "max")
                 break
             alpha = max(alpha, maxValue)
-        return maxValue
+        self.stats["maxNodes"] += 1
+        return maxValue, bestAction
 
-    def betaPart(self, depth, gameState, player, alpha, beta):
+    def betaPart(self, depth, gameState, player, alpha, beta, hint=None):
+        ply = depth * gameState.getNumAgents() + player
+        nodeDepth = depth
         nextPlayer = player + 1
         if player == gameState.getNumAgents() - 1:
             nextPlayer = 0
@@ -84,26 +524,739 @@ class AIAgent(MultiAgentSearchAgent):
             depth += 1
 
         minValue = float('inf')
+        bestAction = None
         legalActions = getPossibleActions(gameState, player)
-        for action in legalActions:
-            minValue = min(minValue,
-                           self.alphaBeta(depth, gameState.generateSuccessor(player, action), nextPlayer, alpha, beta))
+        if self.predictFarGhosts and self.isOutOfReach(gameState, player, self.searchDepth - nodeDepth):
+            legalActions = [self.predictGhostAction(gameState, player, legalActions)]
+            self.stats["predictedGhostMoves"] += 1
+        legalActions = self.ordering.order(gameState, player, ply, legalActions, hint)
+        for index, action in enumerate(legalActions):
+            gameState.applyMove(player, action, trusted=True)
+            try:
+                value = self.alphaBeta(depth, gameState, nextPlayer, alpha, beta)
+            finally:
+                gameState.undoMove()
+            if value < minValue:
+                minValue, bestAction = value, action
             if minValue <= alpha:
+                self.recordCutoff(gameState, player, ply, action, nodeDepth, index, "min")
                 break
             beta = min(beta, minValue)
-        return minValue
+        self.stats["minNodes"] += 1
+        return minValue, bestAction
 
-    def getAction(self, gameState: GameState):
+    def macroPart(self, depth, gameState, alpha, beta, hint=None):
+        "A max node whose moves are corridors, each a whole round of the search"
+        maxValue = float('-inf')
+        bestAction = None
+        ply = depth * gameState.getNumAgents()
+        layout = gameState.data.layout
+        pacmanPosition = gameState.getPacmanPosition()
+        legalActions = self.ordering.order(gameState, 0, ply, getPossibleActions(gameState, 0), hint)
+        for index, action in enumerate(legalActions):
+            played, steps = self.playCorridor(gameState, layout.getCorridor(pacmanPosition, action))
+            self.pathSteps += steps
+            try:
+                value = self.alphaBeta(depth + 1, gameState, 0, alpha, beta)
+            finally:
+                self.pathSteps -= steps
+                for i in range(played):
+                    gameState.undoMove()
+            if value > maxValue:
+                maxValue, bestAction = value, action
+            if maxValue >= beta:
+                self.recordCutoff(gameState, 0, ply, action, depth, index, "max")
+                break
+            alpha = max(alpha, maxValue)
+        self.stats["maxNodes"] += 1
+        return maxValue, bestAction
+
+    def playCorridor(self, gameState, corridor):
+        """
+        Runs Pacman along the corridor in place, each ghost taking its
+        predicted move after every step, until the corridor ends or the game
+        does.  Returns the number of moves to undo and of Pacman's steps.
+        """
+        played = 0
+        steps = 0
+        for action in corridor.actions:
+            if gameState.isWin() or gameState.isLose():
+                break
+            gameState.applyMove(0, action, trusted=True)
+            played += 1
+            steps += 1
+            for ghost in range(1, gameState.getNumAgents()):
+                if gameState.isWin() or gameState.isLose():
+                    break
+                legalActions = getPossibleActions(gameState, ghost)
+                gameState.applyMove(ghost, self.predictGhostAction(gameState, ghost, legalActions), trusted=True)
+                played += 1
+        self.stats["corridors"] += 1
+        self.stats["corridorSteps"] += steps
+        return played, steps
+
+    def isOutOfReach(self, gameState, ghost, rounds):
+        """
+        True if the ghost cannot touch Pacman in the next `rounds` ghost
+        moves (this one included) and the Pacman moves between them, even
+        if both run straight at each other.
+        """
+        pacmanPosition = gameState.getPacmanPosition()
+        distance = gameState.getMazeDistance(pacmanPosition, gameState.getGhostPosition(ghost))
+        return distance > 2 * rounds
+
+    def predictGhostAction(self, gameState, ghost, legalActions):
+        """
+        The move that takes the ghost closest to Pacman along the maze, or
+        furthest from him while it is scared.  Ties go to the first move.
+        """
+        pacmanPosition = gameState.getPacmanPosition()
+        ghostState = gameState.getGhostState(ghost)
+        x, y = ghostState.getPosition()
+        scared = ghostState.scaredTimer > 0
+        speed = 1.0
+        if scared:
+            speed = 0.5
+
+        def distanceAfter(action):
+            dx, dy = Actions.directionToVector(action, speed)
+            return gameState.getMazeDistance((x + dx, y + dy), pacmanPosition)
+
+        if scared:
+            return max(legalActions, key=distanceAfter)
+        return min(legalActions, key=distanceAfter)
+
+    def recordCutoff(self, gameState, player, ply, action, depth, index, nodeType):
+        """
+        Tells the move ordering about a cutoff and counts it.  A cutoff on the
+        first move tried means the ordering put the best move first.
+        """
+        self.ordering.recordCutoff(gameState, player, ply, action, self.searchDepth - depth)
+        self.stats[nodeType + "Cutoffs"] += 1
+        if index == 0:
+            self.stats[nodeType + "FirstMoveCutoffs"] += 1
+
+    def raiseSharedAlpha(self, value):
+        with self.alphaLock:
+            if value > self.sharedAlpha.value:
+                self.sharedAlpha.value = value
+
+    def getPool(self):
+        """
+        Starts the worker processes on first use; they are kept until the
+        end of the game (see close), so their transposition tables survive
+        between moves.
+        """
+        if self.pool is None:
+            self.rootAlpha = multiprocessing.RawValue('d', float('-inf'))
+            self.rootAlphaLock = multiprocessing.Lock()
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_initSearchWorker,
+                initargs=(self.__class__, self.workerArgs, self.rootAlpha, self.rootAlphaLock),
+            )
+        return self.pool
+
+    def close(self):
+        "Shuts down the worker processes, if any; getPool starts new ones"
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def final(self, state):
+        self.close()
+        if self.showStats:
+            self.printStats()
+        # Start the next game's figures from zero
+        self.stats = util.Counter()
+        self.transpositionTable.probes = 0
+        self.transpositionTable.hits = 0
+
+    def printStats(self):
+        "Prints the search figures of the game that just ended"
+        for nodeType in self.nodeTypes:
+            nodes = self.stats[nodeType + "Nodes"]
+            cutoffs = self.stats[nodeType + "Cutoffs"]
+            firstMove = self.stats[nodeType + "FirstMoveCutoffs"]
+            print(
+                "%s nodes: %d, cutoffs: %d (%.1f%%), on the first move: %.1f%%"
+                % (nodeType, nodes, cutoffs, 100.0 * cutoffs / max(nodes, 1), 100.0 * firstMove / max(cutoffs, 1))
+            )
+        table = self.transpositionTable
+        print("Transposition table hits: %d of %d probes" % (table.hits, table.probes))
+        nodes = sum([self.stats[nodeType + "Nodes"] for nodeType in self.nodeTypes])
+        seconds = self.stats["searchTime"]
+        print("Searched %d nodes in %.2fs (%.0f nodes/s)" % (nodes, seconds, nodes / max(seconds, 1e-9)))
+        if self.predictFarGhosts:
+            print("Far ghosts moved without branching: %d times" % self.stats["predictedGhostMoves"])
+        if self.macroActions:
+            corridors = self.stats["corridors"]
+            steps = self.stats["corridorSteps"]
+            print("Corridors run: %d, %.1f steps each" % (corridors, steps / max(corridors, 1)))
+
+    def searchRootMove(self, gameState, action, alpha):
+        "Returns the value of the root move `action`, or a bound at most alpha"
+        if self.macroActions:
+            state = GameState(gameState)
+            corridor = gameState.data.layout.getCorridor(gameState.getPacmanPosition(), action)
+            played, self.pathSteps = self.playCorridor(state, corridor)
+            try:
+                return self.alphaBeta(1, state, 0, alpha, float('inf'))
+            finally:
+                self.pathSteps = 0
+        return self.alphaBeta(0, gameState.generateSuccessorUnchecked(0, action), 1, alpha, float('inf'))
+
+    def searchRoot(self, gameState, legalActions, values):
+        """
+        Searches the root moves in order, recording each value in `values` as
+        soon as that move has been completely searched.  Moves that cannot
+        beat the best one get an upper bound rather than their exact value.
+        """
+        if self.workers > 0 and len(legalActions) > 1:
+            return self.searchRootParallel(gameState, legalActions, values)
         alpha = float('-inf')
-        beta = float('inf')
-        legalActions = getPossibleActions(gameState, 0)
-        bestAction = []
         for action in legalActions:
-            bestAction.append(self.alphaBeta(0, gameState.generateSuccessor(0, action), 1, alpha, beta))
-        choosen = np.argmax(bestAction)
-        max_indices = [index for index in range(len(bestAction)) if bestAction[index] == bestAction[choosen]]
-        chosenIndex = random.choice(max_indices)
-        return legalActions[chosenIndex]
+            value = self.searchRootMove(gameState, action, alpha)
+            values[action] = value
+            alpha = max(alpha, value - ROOT_TIE_MARGIN)
+
+    def searchRootParallel(self, gameState, legalActions, values):
+        """
+        Young Brothers Wait: the first (principal) move is searched here to
+        get a good alpha bound, then its brothers are searched at once by the
+        worker processes.  A worker that finishes a move raises the shared
+        bound for the others.
+        """
+        first = legalActions[0]
+        values[first] = self.searchRootMove(gameState, first, float('-inf'))
+        pool = self.getPool()
+        self.rootAlpha.value = values[first] - ROOT_TIE_MARGIN
+        futures = {}
+        for action in legalActions[1:]:
+            future = pool.submit(_searchRootMove, gameState, action, self.searchCount, self.searchDepth, self.deadline)
+            futures[future] = action
+        timedOut = False
+        for future in as_completed(futures):
+            result = future.result()
+            if result is None:
+                timedOut = True
+                continue
+            value, reachedHorizon, stats = result
+            values[futures[future]] = value
+            self.reachedHorizon = self.reachedHorizon or reachedHorizon
+            self.stats += stats
+        if timedOut:
+            raise SearchTimeout()
+
+    def getAction(self, gameState: GameState):
+        self.searchCount += 1
+        self.newSearch()
+        start = time.time()
+        self.deadline = None
+        if self.time_limit > 0:
+            self.deadline = start + self.time_limit
+
+        legalActions = getPossibleActions(gameState, 0)
+        bestActions = legalActions[:1]
+        searchDepth = 1
+        while self.depth <= 0 or searchDepth <= self.depth:
+            self.searchDepth = searchDepth
+            self.reachedHorizon = False
+            values = {}
+            try:
+                self.searchRoot(gameState, legalActions, values)
+            except SearchTimeout:
+                # The previous principal move is searched first, so any
+                # finished move that beats it was found at the new depth.
+                if legalActions[0] in values:
+                    bestValue = max(values.values())
+                    bestActions = [a for a in legalActions if values.get(a) == bestValue]
+                break
+            bestValue = max(values.values())
+            bestActions = [a for a in legalActions if values[a] == bestValue]
+            if not self.reachedHorizon:
+                break  # Every line ended the game; searching deeper changes nothing
+            # Search the principal move first next time, then the rest from best to worst
+            legalActions.sort(key=lambda a: values[a], reverse=True)
+            searchDepth += 1
+
+        self.deadline = None
+        self.stats["searchTime"] += time.time() - start
+        return random.choice(bestActions)
+
+
+class ExpectimaxAgent(AIAgent):
+    """
+    Expectimax search against a model of the ghosts: ghost moves are chance
+    nodes weighted by the `getDistribution` of the ghostModel class from
+    ghostAgents (DirectionalGhost or RandomGhost).  Everything else, the
+    deepening, deadline, transposition table and workers, is as in AIAgent,
+    except that a worker only uses the bound found by the others when it
+    starts a root move: Star1 rescales the window under each chance node, so
+    that bound does not hold further down.
+
+    Chance nodes are pruned with Star1 and Star2.  `evalBounds` names a
+    function giving (lower, upper) bounds on the evaluation below a state
+    (see scoreEvaluationBounds).  Star1 stops searching a chance node's moves
+    once the moves searched so far decide it against the window, whatever the
+    rest turn out to be within the bounds.  Before that, if the next move is
+    Pacman's, Star2 probes one Pacman reply under each ghost move: each probe
+    is a lower bound for that move, and together they may already fail high.
+    probe=False turns Star2 off, evalBounds=noEvaluationBounds both.
+    AIAgent's predictFarGhosts and macroActions would skip or replace these
+    chance nodes, so they are refused.
+    """
+
+    nodeTypes = ["max", "chance"]
+    sharedAlphaAtNodes = False
+
+    def __init__(
+        self,
+        evalFn="vectorizedEvaluationFunction",
+        depth="2",
+        time_limit="6",
+        ttSize="65536",
+        ordering="KillerHistoryOrdering",
+        showStats="False",
+        workers="0",
+        ghostModel="DirectionalGhost",
+        evalBounds="scoreEvaluationBounds",
+        probe="True",
+        predictFarGhosts="False",
+        macroActions="False",
+    ):
+        AIAgent.__init__(
+            self, evalFn, depth, time_limit, ttSize, ordering, showStats, workers, predictFarGhosts, macroActions
+        )
+        if self.predictFarGhosts or self.macroActions:
+            raise Exception("ExpectimaxAgent does not support predictFarGhosts or macroActions")
+        self.setGhostModel(ghostModel)
+        self.evaluationBounds = util.lookup(evalBounds, globals())
+        self.probe = isTrue(probe)
+        self.workerArgs.update(ghostModel=ghostModel, evalBounds=evalBounds, probe=probe)
+
+    def betaPart(self, depth, gameState, player, alpha, beta, hint=None):
+        "Ghost moves are chance nodes; returns (value, the move that cut, if any)"
+        ply = depth * gameState.getNumAgents() + player
+        nodeDepth = depth
+        nextPlayer = player + 1
+        if player == gameState.getNumAgents() - 1:
+            nextPlayer = 0
+        if nextPlayer == 0:
+            depth += 1
+        self.stats["chanceNodes"] += 1
+
+        distribution = self.getGhostModel(player).getDistribution(gameState)
+        actions = [a for a in distribution.keys() if distribution[a] > 0]
+        if len(actions) == 0:  # A ghost with nowhere to go passes
+            return self.alphaBeta(depth, gameState, nextPlayer, alpha, beta), None
+        # Likely moves first, which narrows the bounds fastest.  The order is
+        # always the same, so an exact value is always summed the same way.
+        actions.sort(key=lambda a: distribution[a], reverse=True)
+        probabilities = [distribution[a] for a in actions]
+        lower, upper = self.evaluationBounds(gameState, self.searchDepth - nodeDepth)
+        lowers = [lower] * len(actions)
+
+        if nextPlayer == 0 and self.probe and beta < upper:
+            # Star2, when the node can fail high at all
+            for index, action in enumerate(actions):
+                probability = probabilities[index]
+                others = expectedValue(probabilities, lowers) - probability * lowers[index]
+                probeBeta = (beta - others) / probability
+                gameState.applyMove(player, action, trusted=True)
+                try:
+                    # A probe that fails low only bounds the reply from above
+                    lowers[index] = max(lower, self.probeReply(depth, gameState, lower, probeBeta))
+                finally:
+                    gameState.undoMove()
+                bound = expectedValue(probabilities, lowers)
+                if bound >= beta:
+                    self.stats["chanceProbeCutoffs"] += 1
+                    return bound, None
+
+        # Star1
+        total = 0.0
+        for index, action in enumerate(actions):
+            probability = probabilities[index]
+            rest = index + 1
+            restLower = expectedValue(probabilities[rest:], lowers[rest:])
+            restUpper = expectedValue(probabilities[rest:], [upper] * (len(actions) - rest))
+            childAlpha = (alpha - total - restUpper) / probability
+            childBeta = (beta - total - restLower) / probability
+            gameState.applyMove(player, action, trusted=True)
+            try:
+                value = self.alphaBeta(depth, gameState, nextPlayer, childAlpha, childBeta)
+            finally:
+                gameState.undoMove()
+            total += probability * value
+            # The bounds are clamped to the window, which rounding could miss
+            if value <= childAlpha or total + restUpper <= alpha:
+                self.recordCutoff(gameState, player, ply, action, nodeDepth, index, "chance")
+                return min(total + restUpper, alpha), action
+            if value >= childBeta or total + restLower >= beta:
+                self.recordCutoff(gameState, player, ply, action, nodeDepth, index, "chance")
+                return max(total + restLower, beta), action
+        return total, None
+
+    def probeReply(self, depth, gameState, alpha, beta):
+        """
+        Searches only the Pacman move that would be searched first from
+        gameState, whose value is a lower bound on the value of gameState.
+        The same move is tried first when the state is searched in full, and
+        its value then comes back from the transposition table.
+        """
+        self.stats["probes"] += 1
+        if gameState.isWin() or gameState.isLose() or depth == self.searchDepth:
+            return self.alphaBeta(depth, gameState, 0, alpha, beta)
+        entry = self.transpositionTable.lookup((0, stateKey(gameState)))
+        hint = None
+        if entry is not None:
+            hint = entry[3]
+        ply = depth * gameState.getNumAgents()
+        actions = self.ordering.order(gameState, 0, ply, getPossibleActions(gameState, 0), hint)
+        gameState.applyMove(0, actions[0], trusted=True)
+        try:
+            return self.alphaBeta(depth, gameState, 1, alpha, beta)
+        finally:
+            gameState.undoMove()
+
+    def printStats(self):
+        AIAgent.printStats(self)
+        print(
+            "Star2 probes: %d, chance nodes cut by them: %d"
+            % (self.stats["probes"], self.stats["chanceProbeCutoffs"])
+        )
+
+
+class BestReplyAgent(AIAgent):
+    """
+    Best-Reply Search.  After each Pacman move a single min node picks one
+    ghost and its move, the most dangerous reply, while every other ghost
+    plays the move its ghostModel policy thinks most likely.  A round then
+    costs Pacman's branching times the sum of the ghosts' branching rather
+    than their product, so the same node budget reaches more Pacman moves.
+    Otherwise the search is AIAgent's.
+
+    With showStats, the ghost moves searched are compared with what a
+    paranoid search (AIAgent) would search at the same min nodes: for each
+    ghost, every move of the ghosts before it.  That leaves out the subtrees
+    below, so the whole tree saves more than it shows.  AIAgent's
+    predictFarGhosts and macroActions would skip or replace the reply nodes,
+    so they are refused.
+    """
+
+    def __init__(
+        self,
+        evalFn="vectorizedEvaluationFunction",
+        depth="2",
+        time_limit="6",
+        ttSize="65536",
+        ordering="KillerHistoryOrdering",
+        showStats="False",
+        workers="0",
+        ghostModel="DirectionalGhost",
+        predictFarGhosts="False",
+        macroActions="False",
+    ):
+        AIAgent.__init__(
+            self, evalFn, depth, time_limit, ttSize, ordering, showStats, workers, predictFarGhosts, macroActions
+        )
+        if self.predictFarGhosts or self.macroActions:
+            raise Exception("BestReplyAgent does not support predictFarGhosts or macroActions")
+        self.setGhostModel(ghostModel)
+        self.workerArgs.update(ghostModel=ghostModel)
+
+    def policyAction(self, gameState, index):
+        "The ghost's most likely move under the model, which keeps the search deterministic"
+        return self.getGhostModel(index).getDistribution(gameState).argMax()
+
+    def playReply(self, gameState, ghost, action, policyMoves):
+        """
+        Plays every ghost's move in turn, `action` for `ghost` and the policy
+        move for the others.  Returns the number of moves to undo.
+
+        The ghosts before `ghost` move as they would in every other reply
+        that comes later, so their policy moves are kept in policyMoves.
+        """
+        played = 0
+        for index in range(1, gameState.getNumAgents()):
+            if gameState.isWin() or gameState.isLose():
+                break
+            if index == ghost:
+                gameState.applyMove(index, action, trusted=True)
+            elif index < ghost:
+                if index not in policyMoves:
+                    policyMoves[index] = self.policyAction(gameState, index)
+                gameState.applyMove(index, policyMoves[index], trusted=True)
+            else:
+                gameState.applyMove(index, self.policyAction(gameState, index), trusted=True)
+            played += 1
+        return played
+
+    def betaPart(self, depth, gameState, player, alpha, beta, hint=None):
+        "The ghosts' move as one min node over (ghost, move) replies"
+        numAgents = gameState.getNumAgents()
+        pacmanPosition = gameState.getPacmanPosition()
+        ghosts = list(range(1, numAgents))
+        # The closest ghosts are the likeliest to refute Pacman's move
+        ghosts.sort(key=lambda g: gameState.getMazeDistance(pacmanPosition, gameState.getGhostPosition(g)))
+        replies = []
+        branching = {}
+        for ghost in ghosts:
+            ghostHint = None
+            if hint is not None and hint[0] == ghost:
+                ghostHint = hint[1]
+            ply = depth * numAgents + ghost
+            actions = self.ordering.order(gameState, ghost, ply, getPossibleActions(gameState, ghost), ghostHint)
+            replies += [(ghost, action) for action in actions]
+            branching[ghost] = len(actions)
+        putFirst(replies, hint)
+        self.stats["bestReplyGhostMoves"] += len(replies)
+        paranoidMoves = 1
+        for ghost in range(1, numAgents):  # A paranoid search's min layers
+            paranoidMoves *= branching[ghost]
+            self.stats["paranoidGhostMoves"] += paranoidMoves
+
+        minValue = float('inf')
+        bestReply = None
+        policyMoves = {}
+        for index, reply in enumerate(replies):
+            played = self.playReply(gameState, reply[0], reply[1], policyMoves)
+            try:
+                value = self.alphaBeta(depth + 1, gameState, 0, alpha, beta)
+            finally:
+                for i in range(played):
+                    gameState.undoMove()
+            if value < minValue:
+                minValue, bestReply = value, reply
+            if minValue <= alpha:
+                ghost, action = reply
+                self.recordCutoff(gameState, ghost, depth * numAgents + ghost, action, depth, index, "min")
+                break
+            beta = min(beta, minValue)
+        self.stats["minNodes"] += 1
+        return minValue, bestReply
+
+    def printStats(self):
+        AIAgent.printStats(self)
+        searched = self.stats["bestReplyGhostMoves"]
+        paranoid = self.stats["paranoidGhostMoves"]
+        print(
+            "Ghost moves searched: %d, a paranoid search of the same nodes: %d (%d saved, %.1f%%)"
+            % (searched, paranoid, paranoid - searched, 100.0 * (paranoid - searched) / max(paranoid, 1))
+        )
+
+
+class MCTSNode:
+    """
+    A position in the Monte Carlo search tree where Pacman is to move.  Each
+    of Pacman's moves from it is an MCTSEdge.
+    """
+
+    __slots__ = ("visits", "edges")
+
+    def __init__(self):
+        self.visits = 0
+        self.edges = None  # action -> MCTSEdge, once expanded
+
+
+class MCTSEdge:
+    """
+    One of Pacman's moves in the search tree, with the total reward of the
+    rollouts through it.  The ghosts' replies are sampled, so a move leads to
+    one child node per outcome seen, keyed by the resulting stateKey.
+    """
+
+    __slots__ = ("visits", "totalReward", "outcomes")
+
+    def __init__(self):
+        self.visits = 0
+        self.totalReward = 0.0
+        self.outcomes = {}
+
+
+class MCTSAgent(MultiAgentSearchAgent):
+    """
+    Monte Carlo tree search with UCT.  Each iteration walks down the tree,
+    choosing Pacman's moves by UCT and sampling the ghosts' from the
+    ghostModel policy, adds one node, then plays a random rollout of at most
+    rolloutDepth rounds and backs its evaluation up the path.
+
+    getAction runs iterations until time_limit seconds have passed or, if
+    iterations > 0, that many have run, and plays the most visited move.  The
+    subtree under the move played and the ghosts' actual replies is kept as
+    the root of the next search.
+
+    Moves are played in place (GameState.applyMove) and the ghost policies
+    are called directly, rather than going through the Game loop.  Rewards
+    are scaled to [0, 1] by the lowest and highest rollout values seen in the
+    current search, so `exploration` does not depend on the evaluation
+    function's units.  With
+    showStats, the number of simulated moves per second is printed at the
+    end of each game.
+    """
+
+    def __init__(
+        self,
+        evalFn="rolloutEvaluationFunction",
+        time_limit="1",
+        iterations="0",
+        rolloutDepth="5",
+        exploration="1.41",
+        ghostModel="DirectionalGhost",
+        showStats="False",
+    ):
+        MultiAgentSearchAgent.__init__(self, evalFn, "0", time_limit)
+        self.iterations = int(iterations)
+        if self.iterations <= 0 and self.time_limit <= 0:
+            raise Exception("MCTSAgent needs a positive time_limit or a positive number of iterations")
+        self.rolloutDepth = int(rolloutDepth)
+        self.exploration = float(exploration)
+        self.setGhostModel(ghostModel)
+        self.showStats = isTrue(showStats)
+        self.stats = util.Counter()
+        self.root = None
+        self.lastAction = None
+        self.lowestReward = float('inf')
+        self.highestReward = float('-inf')
+
+    def findRoot(self, gameState):
+        "Returns the node of the last search that matches gameState, or a new one"
+        if self.root is not None and self.root.edges is not None:
+            edge = self.root.edges.get(self.lastAction)
+            if edge is not None:
+                node = edge.outcomes.get(stateKey(gameState))
+                if node is not None:
+                    self.stats["reusedVisits"] += node.visits
+                    return node
+        return MCTSNode()
+
+    def selectEdge(self, node):
+        "The UCT choice among node's edges, trying every move once first"
+        unvisited = [action for action, edge in node.edges.items() if edge.visits == 0]
+        if len(unvisited) > 0:
+            return random.choice(unvisited)
+        lowest = self.lowestReward
+        scale = max(self.highestReward - lowest, 1e-9)
+        logVisits = np.log(node.visits)
+        bestAction, bestValue = None, float('-inf')
+        for action, edge in node.edges.items():
+            mean = (edge.totalReward / edge.visits - lowest) / scale
+            value = mean + self.exploration * np.sqrt(logVisits / edge.visits)
+            if value > bestValue:
+                bestAction, bestValue = action, value
+        return bestAction
+
+    def rolloutAction(self, state):
+        "A random move for Pacman that, like a ghost, only turns back at a dead end"
+        actions = getPossibleActions(state, 0)
+        reverse = Actions.reverseDirection(state.data.agentStates[0].configuration.direction)
+        if reverse in actions and len(actions) > 1:
+            actions.remove(reverse)
+        return random.choice(actions)
+
+    def playGhosts(self, state):
+        "Plays every ghost's move from its policy; returns the number of moves played"
+        played = 0
+        for index in range(1, state.getNumAgents()):
+            if state.isWin() or state.isLose():
+                break
+            state.applyMove(index, self.getGhostModel(index).getAction(state), trusted=True)
+            played += 1
+        return played
+
+    def runIteration(self, root, state):
+        """
+        Runs one selection, expansion, rollout and backup from root, whose
+        position is `state`.  Every move is undone again before returning.
+        """
+        nodes = [root]
+        edges = []
+        played = 0
+        node = root
+        try:
+            # Selection and expansion: stop at the first new node
+            while not (state.isWin() or state.isLose()):
+                if node.edges is None:
+                    node.edges = dict([(a, MCTSEdge()) for a in getPossibleActions(state, 0)])
+                action = self.selectEdge(node)
+                edge = node.edges[action]
+                state.applyMove(0, action, trusted=True)
+                played += 1 + self.playGhosts(state)
+                edges.append(edge)
+                key = stateKey(state)
+                child = edge.outcomes.get(key)
+                if child is None:
+                    child = MCTSNode()
+                    edge.outcomes[key] = child
+                nodes.append(child)
+                node = child
+                if child.visits == 0:
+                    break
+
+            # Rollout
+            for i in range(self.rolloutDepth):
+                if state.isWin() or state.isLose():
+                    break
+                state.applyMove(0, self.rolloutAction(state), trusted=True)
+                played += 1 + self.playGhosts(state)
+            reward = self.evaluationFunction(state)
+        finally:
+            for i in range(played):
+                state.undoMove()
+        self.stats["simulatedMoves"] += played
+
+        # Backup
+        self.lowestReward = min(self.lowestReward, reward)
+        self.highestReward = max(self.highestReward, reward)
+        for node in nodes:
+            node.visits += 1
+        for edge in edges:
+            edge.visits += 1
+            edge.totalReward += reward
+
+    def getAction(self, gameState: GameState):
+        start = time.time()
+        root = self.findRoot(gameState)
+        state = GameState(gameState)
+        # Rescale to the rewards under the new root
+        means = []
+        if root.edges is not None:
+            means = [e.totalReward / e.visits for e in root.edges.values() if e.visits > 0]
+        self.lowestReward = min(means + [float('inf')])
+        self.highestReward = max(means + [float('-inf')])
+        iterations = 0
+        while self.iterations <= 0 or iterations < self.iterations:
+            if self.time_limit > 0 and time.time() - start > self.time_limit:
+                break
+            self.runIteration(root, state)
+            iterations += 1
+        self.stats["iterations"] += iterations
+        self.stats["searchTime"] += time.time() - start
+
+        if root.edges is None:  # Not even one iteration
+            legalActions = getPossibleActions(gameState, 0)
+            self.lastAction = random.choice(legalActions)
+        else:
+            mostVisits = max([edge.visits for edge in root.edges.values()])
+            self.lastAction = random.choice(
+                [action for action, edge in root.edges.items() if edge.visits == mostVisits]
+            )
+        self.root = root
+        return self.lastAction
+
+    def final(self, state):
+        self.root = None
+        self.lastAction = None
+        if self.showStats:
+            moves = self.stats["simulatedMoves"]
+            seconds = self.stats["searchTime"]
+            print(
+                "MCTS iterations: %d, simulated moves: %d in %.2fs (%.0f moves/s)"
+                % (self.stats["iterations"], moves, seconds, moves / max(seconds, 1e-9))
+            )
+            print("Visits reused from the previous move's tree: %d" % self.stats["reusedVisits"])
+        self.stats = util.Counter()
 
 
 class MiniMaxAgent(MultiAgentSearchAgent):
@@ -119,7 +1272,7 @@ class MiniMaxAgent(MultiAgentSearchAgent):
         maxValue = float('-inf')
         legalActions = getPossibleActions(gameState, player)
         for action in legalActions:
-            temp = self.minimax(depth, gameState.generateSuccessor(player, action), 1)
+            temp = self.minimax(depth, gameState.generateSuccessorUnchecked(player, action), 1)
             if temp > maxValue:
                 maxValue = temp
         return maxValue
@@ -133,7 +1286,7 @@ class MiniMaxAgent(MultiAgentSearchAgent):
         minValue = float('inf')
         legalActions = getPossibleActions(gameState, player)
         for action in legalActions:
-            temp = self.minimax(depth, gameState.generateSuccessor(player, action), nextPlayer)
+            temp = self.minimax(depth, gameState.generateSuccessorUnchecked(player, action), nextPlayer)
             if temp < minValue:
                 minValue = temp
         return minValue
@@ -142,7 +1295,7 @@ class MiniMaxAgent(MultiAgentSearchAgent):
         legalActions = getPossibleActions(gameState, 0)
         bestAction = []
         for action in legalActions:
-            bestAction.append(self.minimax(0, gameState.generateSuccessor(0, action), 1))
+            bestAction.append(self.minimax(0, gameState.generateSuccessorUnchecked(0, action), 1))
         choosen = np.argmax(bestAction)
         max_indices = [index for index in range(len(bestAction)) if bestAction[index] == bestAction[choosen]]
         chosenIndex = random.choice(max_indices)
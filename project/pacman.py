@@ -41,12 +41,17 @@ The keys are 'a', 's', 'd', and 'w' to move (or arrow keys).  Have fun!
 """
 from game import GameStateData
 from game import Game
+from game import Zobrist
 from game import Directions
 from game import Actions
-from util import nearestPoint
-from util import manhattanDistance
+from game import Configuration
+from game import AgentState
+from game import Grid
+from util import nearestPoint  # Used as pacman.nearestPoint by textDisplay
 import util
 import layout
+from layout import getLayoutByHash
+import struct
 import sys
 import types
 import time
@@ -57,6 +62,73 @@ import os
 # YOUR INTERFACE TO THE PACMAN WORLD: A GameState #
 ###################################################
 
+# Binary snapshots (see GameState.toBytes).  All fields are little-endian:
+#   header    magic, version, total length in bytes, layout content hash
+#   state     score, Zobrist hash, food count, agent moved (-1 for none),
+#             flags (1 win, 2 lose), number of capsules, number of agents
+#   food      the layout-sized food bitset (Grid.toBytes)
+#   capsules  (x, y) for each capsule
+#   agents    position and start position in half cells, their directions,
+#             scared timer and isPacman, for each agent
+SNAPSHOT_MAGIC = b"PMS"
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct("<3sBI20s")
+_SNAPSHOT_STATE = struct.Struct("<dQHbBBB")
+_SNAPSHOT_CAPSULE = struct.Struct("<BB")
+_SNAPSHOT_AGENT = struct.Struct("<HHBHHBBB")
+_SNAPSHOT_DIRECTIONS = [
+    Directions.NORTH,
+    Directions.SOUTH,
+    Directions.EAST,
+    Directions.WEST,
+    Directions.STOP,
+]
+_SNAPSHOT_DIRECTION_CODES = dict([(d, i) for i, d in enumerate(_SNAPSHOT_DIRECTIONS)])
+
+
+def _fromHalfCells(hx, hy):
+    "Turns a position in half cells back into game coordinates"
+    return (hx // 2 if hx % 2 == 0 else hx / 2.0, hy // 2 if hy % 2 == 0 else hy / 2.0)
+
+
+class ExplorationTracker:
+    """
+    Counts the successors generated while it is active, for instrumenting a
+    search.  Tracking is off unless a tracker is active:
+
+        tracker = ExplorationTracker()
+        with tracker:
+            action = agent.getAction(state)
+        print(tracker.expansions)
+
+    Entering the same tracker again keeps adding to its counts, so one
+    tracker per agent measures a whole game and a new one per call measures a
+    single move.  With keepKeys, the hash keys of the expanded states are also
+    kept in `explored`, which is enough to count distinct states without
+    keeping the states alive.
+    """
+
+    def __init__(self, keepKeys=False):
+        self.keepKeys = keepKeys
+        self.expansions = 0  # generateSuccessor and applyMove calls
+        self.explored = set()
+        self._previous = None
+
+    def record(self, state):
+        self.expansions += 1
+        if self.keepKeys:
+            self.explored.add(hash(state))
+
+    def __enter__(self):
+        self._previous = GameState.tracker
+        GameState.tracker = self
+        return self
+
+    def __exit__(self, *exc):
+        GameState.tracker = self._previous
+        self._previous = None
+        return False
+
 
 class GameState:
     """
@@ -77,12 +149,23 @@ class GameState:
     # Accessor methods: use these to access state data #
     ####################################################
 
-    # static variable keeps track of which states have had getLegalActions called
-    explored = set()
+    # The active ExplorationTracker, or None when tracking is off
+    tracker = None
+
+    # Moves played with applyMove, so that undoMove can take them back
+    _undoStack = None
+    _savedAgents = None
 
     def getAndResetExplored():
-        tmp = GameState.explored.copy()
-        GameState.explored = set()
+        """
+        Returns the keys of the states expanded since the last call, as kept
+        by the active ExplorationTracker (if it has keepKeys), and clears them.
+        """
+        tracker = GameState.tracker
+        if tracker is None:
+            return set()
+        tmp = tracker.explored
+        tracker.explored = set()
         return tmp
 
     getAndResetExplored = staticmethod(getAndResetExplored)
@@ -91,7 +174,6 @@ class GameState:
         """
         Returns the legal actions for the agent specified.
         """
-        #        GameState.explored.add(self)
         if self.isWin() or self.isLose():
             return []
 
@@ -108,31 +190,188 @@ class GameState:
         if self.isWin() or self.isLose():
             raise Exception("Can't generate a successor of a terminal state.")
 
+        return self._generateSuccessor(agentIndex, action, False)
+
+    def generateSuccessorUnchecked(self, agentIndex, action):
+        """
+        generateSuccessor for search engines that took the action from
+        getLegalActions of this same, non-terminal, state: it skips checking
+        that the state is not over and that the action is legal.  Passing an
+        illegal action or a finished state gives an undefined result, so moves
+        from agents (as in Game.run) go through generateSuccessor.
+        """
+        return self._generateSuccessor(agentIndex, action, True)
+
+    def _generateSuccessor(self, agentIndex, action, trusted):
         # Copy current state
         state = GameState(self)
+        changed = state.moveAgent(agentIndex, action, trusted)
+
+        # Book keeping
+        for index in changed:
+            state.data._hash ^= Zobrist.agentKey(
+                index, self.data.agentStates[index]
+            ) ^ Zobrist.agentKey(index, state.data.agentStates[index])
+        if GameState.tracker is not None:
+            GameState.tracker.record(self)
+        return state
+
+    def applyMove(self, agentIndex, action, trusted=False):
+        """
+        Plays the move on this state in place, instead of copying it like
+        generateSuccessor.  undoMove restores the state exactly as it was, so
+        a depth-first search can walk the tree with one working state:
+
+            state.applyMove(agentIndex, action)
+            ... search state ...
+            state.undoMove()
+
+        Moves must be undone in the reverse order they were applied.  As with
+        generateSuccessorUnchecked, a trusted move is not checked.
+        """
+        if not trusted and (self.isWin() or self.isLose()):
+            raise Exception("Can't apply a move to a terminal state.")
+        if GameState.tracker is not None:
+            GameState.tracker.record(self)
+        data = self.data
+        mover = data.agentStates[agentIndex]
+        configuration = mover.configuration
+        scaredTimer = mover.scaredTimer
+        if self._undoStack is None:
+            self._undoStack = []
+        # The rules replace, rather than edit, the food grid, the capsules and
+        # _eaten, so keeping references to them is enough to undo.  Only the
+        # mover is saved here: the other agents are saved by saveAgents, if
+        # the move changes them.
+        self._undoStack.append(
+            (
+                None,
+                agentIndex,
+                configuration,
+                scaredTimer,
+                data.food,
+                data._numFood,
+                data._foodPositions,
+                data._foodArray,
+                data.capsules,
+                data._eaten,
+                data.score,
+                data.scoreChange,
+                data._hash,
+                data._win,
+                data._lose,
+                data._agentMoved,
+                data._foodEaten,
+                data._foodAdded,
+                data._capsuleEaten,
+            )
+        )
+        data.scoreChange = 0
+        data._foodEaten = None
+        data._foodAdded = None
+        data._capsuleEaten = None
+        self._savedAgents = None
+        try:
+            changed = self.moveAgent(agentIndex, action, trusted)
+        except Exception:
+            self._savedAgents = None
+            self.undoMove()  # An illegal move leaves the state as it was
+            raise
+
+        agents = self._savedAgents
+        if agents is None:
+            data._hash ^= Zobrist.configurationKey(
+                agentIndex, configuration, scaredTimer
+            ) ^ Zobrist.agentKey(agentIndex, data.agentStates[agentIndex])
+            return
+        self._savedAgents = None
+        agents[agentIndex] = (configuration, scaredTimer)
+        self._undoStack[-1] = (agents,) + self._undoStack[-1][1:]
+        for index in changed:
+            configuration, scaredTimer = agents[index]
+            data._hash ^= Zobrist.configurationKey(
+                index, configuration, scaredTimer
+            ) ^ Zobrist.agentKey(index, data.agentStates[index])
+
+    def undoMove(self):
+        """
+        Takes back the last move played with applyMove.
+        """
+        data = self.data
+        (
+            agents,
+            agentIndex,
+            configuration,
+            scaredTimer,
+            data.food,
+            data._numFood,
+            data._foodPositions,
+            data._foodArray,
+            data.capsules,
+            data._eaten,
+            data.score,
+            data.scoreChange,
+            data._hash,
+            data._win,
+            data._lose,
+            data._agentMoved,
+            data._foodEaten,
+            data._foodAdded,
+            data._capsuleEaten,
+        ) = self._undoStack.pop()
+        if agents is None:
+            agentState = data.getMutableAgentState(agentIndex)
+            agentState.configuration = configuration
+            agentState.scaredTimer = scaredTimer
+            return
+        for index, (configuration, scaredTimer) in enumerate(agents):
+            agentState = data.agentStates[index]
+            if agentState.configuration is not configuration or agentState.scaredTimer != scaredTimer:
+                agentState = data.getMutableAgentState(index)
+                agentState.configuration = configuration
+                agentState.scaredTimer = scaredTimer
+
+    def saveAgents(self):
+        """
+        Called by the rules before a move changes agents other than the one
+        moving (when Pacman eats a capsule or a ghost), so that applyMove can
+        take them back.  Does nothing outside applyMove.
+        """
+        if self._undoStack is not None and self._savedAgents is None:
+            self._savedAgents = [
+                (s.configuration, s.scaredTimer) for s in self.data.agentStates
+            ]
+
+    def moveAgent(self, agentIndex, action, trusted=False):
+        """
+        Applies the rules of one move to this state's data, in place.  The
+        data must start as a copy of the state before the move with its score
+        change and events cleared.  Returns the indices of the agents that may
+        have changed, whose hash keys the caller must update.
+        """
+        data = self.data
 
         # Let agent's logic deal with its action's effects on the board
         if agentIndex == 0:  # Pacman is moving
-            state.data._eaten = [False for i in range(state.getNumAgents())]
-            PacmanRules.applyAction(state, action)
+            data._eaten = [False for i in range(self.getNumAgents())]
+            PacmanRules.applyAction(self, action, trusted)
         else:  # A ghost is moving
-            GhostRules.applyAction(state, action, agentIndex)
+            GhostRules.applyAction(self, action, agentIndex, trusted)
 
         # Time passes
         if agentIndex == 0:
-            state.data.scoreChange += -TIME_PENALTY  # Penalty for waiting around
+            data.scoreChange += -TIME_PENALTY  # Penalty for waiting around
         else:
-            GhostRules.decrementTimer(state.data.agentStates[agentIndex])
+            GhostRules.decrementTimer(data.getMutableAgentState(agentIndex))
 
         # Resolve multi-agent effects
-        GhostRules.checkDeath(state, agentIndex)
+        GhostRules.checkDeath(self, agentIndex)
 
-        # Book keeping
-        state.data._agentMoved = agentIndex
-        state.data.score += state.data.scoreChange
-        GameState.explored.add(self)
-        GameState.explored.add(state)
-        return state
+        data._agentMoved = agentIndex
+        data.score += data.scoreChange
+        if agentIndex == 0 and (data._capsuleEaten is not None or True in data._eaten):
+            return range(self.getNumAgents())  # Ghosts were scared or eaten
+        return (agentIndex,)
 
     def getLegalPacmanActions(self):
         return self.getLegalActions(0)
@@ -179,12 +418,25 @@ class GameState:
 
     def getCapsules(self):
         """
-        Returns a list of positions (x,y) of the remaining capsules.
+        Returns a tuple of positions (x,y) of the remaining capsules.
         """
         return self.data.capsules
 
     def getNumFood(self):
-        return self.data.food.count()
+        return self.data._numFood
+
+    def getFoodPositions(self):
+        """
+        Returns a tuple of the (x,y) positions of the remaining food.
+        """
+        return self.data.getFoodPositions()
+
+    def getFoodArray(self):
+        """
+        Returns the positions of the remaining food as a NumPy array with one
+        (x,y) row per pellet.  It is read-only, as it is shared between states.
+        """
+        return self.data.getFoodArray()
 
     def getFood(self):
         """
@@ -210,6 +462,14 @@ class GameState:
         """
         return self.data.layout.walls
 
+    def getMazeDistance(self, pos1, pos2):
+        """
+        Returns the length of the shortest path between two positions that
+        does not go through walls.  The distances of a layout are computed
+        once, the first time they are needed.
+        """
+        return self.data.layout.mazeDistance(pos1, pos2)
+
     def hasFood(self, x, y):
         return self.data.food[x][y]
 
@@ -262,6 +522,134 @@ class GameState:
         """
         self.data.initialize(layout, numGhostAgents)
 
+    def toBytes(self):
+        """
+        Returns a compact, versioned binary snapshot of the state: the food
+        bitset, capsules, agent configurations and timers, score and hash.
+        The layout is referenced by its content hash, not included, and the
+        per-move events used by the displays are not kept.
+        """
+        data = self.data
+        layout = data.layout
+        agentMoved = data._agentMoved
+        parts = [
+            None,
+            _SNAPSHOT_STATE.pack(
+                data.score,
+                data._hash,
+                data._numFood,
+                -1 if agentMoved is None else agentMoved,
+                int(data._win) | int(data._lose) << 1,
+                len(data.capsules),
+                len(data.agentStates),
+            ),
+            data.food.toBytes(),
+        ]
+        for x, y in data.capsules:
+            parts.append(_SNAPSHOT_CAPSULE.pack(x, y))
+        codes = _SNAPSHOT_DIRECTION_CODES
+        for agentState in data.agentStates:
+            configuration, start = agentState.configuration, agentState.start
+            parts.append(
+                _SNAPSHOT_AGENT.pack(
+                    configuration.halfPos[0],
+                    configuration.halfPos[1],
+                    codes[configuration.direction],
+                    start.halfPos[0],
+                    start.halfPos[1],
+                    codes[start.direction],
+                    agentState.scaredTimer,
+                    agentState.isPacman,
+                )
+            )
+        length = _SNAPSHOT_HEADER.size + sum([len(part) for part in parts[1:]])
+        parts[0] = _SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, length, layout.contentHash
+        )
+        return b"".join(parts)
+
+    def fromBytes(buffer, offset=0, layout=None):
+        """
+        Rebuilds a state from a snapshot made by toBytes, starting at offset
+        in buffer (anything that supports the buffer protocol).  Fields are
+        read in place with struct.unpack_from and memoryview slices, so a
+        file of concatenated snapshots can be decoded without copying it;
+        the snapshot's length is at snapshotLength(buffer, offset).
+
+        The layout is looked up by content hash among the layouts built in
+        this process, unless it is passed in.
+        """
+        view = memoryview(buffer)
+        magic, version, length, contentHash = _SNAPSHOT_HEADER.unpack_from(view, offset)
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception("Not a game state snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise Exception("Unsupported snapshot version %d" % version)
+        if layout is None:
+            layout = getLayoutByHash(contentHash)
+            if layout is None:
+                raise Exception("The layout of this snapshot has not been loaded")
+        elif layout.contentHash != contentHash:
+            raise Exception("The snapshot was taken on a different layout")
+        offset += _SNAPSHOT_HEADER.size
+
+        score, hashValue, numFood, agentMoved, flags, numCapsules, numAgents = (
+            _SNAPSHOT_STATE.unpack_from(view, offset)
+        )
+        offset += _SNAPSHOT_STATE.size
+        foodSize = (layout.width * layout.height + 7) // 8
+        food = Grid.fromBytes(layout.width, layout.height, view[offset : offset + foodSize])
+        offset += foodSize
+        capsules = []
+        for i in range(numCapsules):
+            capsules.append(_SNAPSHOT_CAPSULE.unpack_from(view, offset))
+            offset += _SNAPSHOT_CAPSULE.size
+        agentStates = []
+        directions = _SNAPSHOT_DIRECTIONS
+        for i in range(numAgents):
+            hx, hy, direction, sx, sy, startDirection, scaredTimer, isPacman = (
+                _SNAPSHOT_AGENT.unpack_from(view, offset)
+            )
+            offset += _SNAPSHOT_AGENT.size
+            start = Configuration.get(_fromHalfCells(sx, sy), directions[startDirection])
+            agentState = AgentState(start, bool(isPacman))
+            agentState.configuration = Configuration.get(
+                _fromHalfCells(hx, hy), directions[direction]
+            )
+            agentState.scaredTimer = scaredTimer
+            agentStates.append(agentState)
+
+        state = GameState()
+        data = state.data
+        data.food = food
+        data.capsules = tuple(capsules)
+        data.agentStates = agentStates
+        data._ownedAgents = (1 << numAgents) - 1
+        data.layout = layout
+        data._eaten = [False for a in agentStates]
+        data.score = score
+        data._hash = hashValue
+        data._numFood = numFood
+        data._foodPositions = None
+        data._foodArray = None
+        data.getFoodArray()  # Kept up to date from here on, see initialize
+        data._agentMoved = None if agentMoved < 0 else agentMoved
+        data._win = bool(flags & 1)
+        data._lose = bool(flags & 2)
+        return state
+
+    fromBytes = staticmethod(fromBytes)
+
+    def snapshotLength(buffer, offset=0):
+        "Returns the length in bytes of the snapshot at offset in buffer"
+        return _SNAPSHOT_HEADER.unpack_from(buffer, offset)[2]
+
+    snapshotLength = staticmethod(snapshotLength)
+
+    def __reduce__(self):
+        # Pickle as a snapshot plus the layout, which pickles as its text
+        return (GameState.fromBytes, (self.toBytes(), 0, self.data.layout))
+
 
 ############################################################################
 #                     THE HIDDEN SECRETS OF PACMAN                         #
@@ -272,6 +660,7 @@ class GameState:
 
 SCARED_TIME = 40  # Moves ghosts are scared
 COLLISION_TOLERANCE = 0.7  # How close ghosts must be to Pacman to kill
+COLLISION_HALF_STEPS = int(2 * COLLISION_TOLERANCE)  # The same in half cells
 TIME_PENALTY = 1  # Number of points lost each round
 
 
@@ -358,32 +747,33 @@ class PacmanRules:
         """
         Returns a list of possible actions.
         """
-        return Actions.getPossibleActions(
-            state.getPacmanState().configuration, state.data.layout.walls
-        )
+        data = state.data
+        return list(data.layout.getPacmanActions(data.agentStates[0].configuration))
 
     getLegalActions = staticmethod(getLegalActions)
 
-    def applyAction(state, action):
+    def applyAction(state, action, trusted=False):
         """
-        Edits the state to reflect the results of the action.
+        Edits the state to reflect the results of the action.  A trusted
+        action is known to be legal and is not checked.
         """
-        legal = PacmanRules.getLegalActions(state)
-        if action not in legal:
+        data = state.data
+        if not trusted and action not in data.layout.getPacmanActions(
+            data.agentStates[0].configuration
+        ):
             raise Exception("Illegal action " + str(action))
 
-        pacmanState = state.data.agentStates[0]
+        pacmanState = data.getMutableAgentState(0)
 
         # Update Configuration
         vector = Actions.directionToVector(action, PacmanRules.PACMAN_SPEED)
         pacmanState.configuration = pacmanState.configuration.generateSuccessor(vector)
 
-        # Eat
-        next = pacmanState.configuration.getPosition()
-        nearest = nearestPoint(next)
-        if manhattanDistance(nearest, next) <= 0.5:
+        # Eat, if within half a cell of a grid point
+        hx, hy = pacmanState.configuration.halfPos
+        if not (hx & 1 and hy & 1):
             # Remove food
-            PacmanRules.consume(nearest, state)
+            PacmanRules.consume(pacmanState.configuration.cell, state)
 
     applyAction = staticmethod(applyAction)
 
@@ -392,21 +782,22 @@ class PacmanRules:
         # Eat food
         if state.data.food[x][y]:
             state.data.scoreChange += 10
-            state.data.food = state.data.food.copy()
-            state.data.food[x][y] = False
+            state.data.removeFood(position)
             state.data._foodEaten = position
-            # TODO: cache numFood?
-            numFood = state.getNumFood()
-            if numFood == 0 and not state.data._lose:
+            state.data._hash ^= Zobrist.foodKey(position)
+            if state.getNumFood() == 0 and not state.data._lose:
                 state.data.scoreChange += 500
                 state.data._win = True
         # Eat capsule
         if position in state.getCapsules():
-            state.data.capsules.remove(position)
+            state.saveAgents()
+            state.data.capsules = tuple([c for c in state.data.capsules if c != position])
             state.data._capsuleEaten = position
+            state.data._hash ^= Zobrist.capsuleKey(position)
             # Reset all ghosts' scared timers
             for index in range(1, len(state.data.agentStates)):
-                state.data.agentStates[index].scaredTimer = SCARED_TIME
+                if state.data.agentStates[index].scaredTimer != SCARED_TIME:
+                    state.data.getMutableAgentState(index).scaredTimer = SCARED_TIME
 
     consume = staticmethod(consume)
 
@@ -424,22 +815,18 @@ class GhostRules:
         reach a dead end, but can turn 90 degrees at intersections.
         """
         conf = state.getGhostState(ghostIndex).configuration
-        possibleActions = Actions.getPossibleActions(conf, state.data.layout.walls)
-        reverse = Actions.reverseDirection(conf.direction)
-        if Directions.STOP in possibleActions:
-            possibleActions.remove(Directions.STOP)
-        if reverse in possibleActions and len(possibleActions) > 1:
-            possibleActions.remove(reverse)
-        return possibleActions
+        return list(state.data.layout.getGhostActions(conf))
 
     getLegalActions = staticmethod(getLegalActions)
 
-    def applyAction(state, action, ghostIndex):
-        legal = GhostRules.getLegalActions(state, ghostIndex)
-        if action not in legal:
+    def applyAction(state, action, ghostIndex, trusted=False):
+        data = state.data
+        if not trusted and action not in data.layout.getGhostActions(
+            data.agentStates[ghostIndex].configuration
+        ):
             raise Exception("Illegal ghost action " + str(action))
 
-        ghostState = state.data.agentStates[ghostIndex]
+        ghostState = data.getMutableAgentState(ghostIndex)
         speed = GhostRules.GHOST_SPEED
         if ghostState.scaredTimer > 0:
             speed /= 2.0
@@ -451,34 +838,42 @@ class GhostRules:
     def decrementTimer(ghostState):
         timer = ghostState.scaredTimer
         if timer == 1:
-            ghostState.configuration.pos = nearestPoint(ghostState.configuration.pos)
+            configuration = ghostState.configuration
+            ghostState.configuration = Configuration.get(
+                configuration.cell, configuration.direction
+            )
         ghostState.scaredTimer = max(0, timer - 1)
 
     decrementTimer = staticmethod(decrementTimer)
 
     def checkDeath(state, agentIndex):
-        pacmanPosition = state.getPacmanPosition()
+        # Distances are measured in half cells, see Configuration.halfPos
+        px, py = state.data.agentStates[0].configuration.halfPos
         if agentIndex == 0:  # Pacman just moved; Anyone can kill him
             for index in range(1, len(state.data.agentStates)):
                 ghostState = state.data.agentStates[index]
-                ghostPosition = ghostState.configuration.getPosition()
-                if GhostRules.canKill(pacmanPosition, ghostPosition):
+                gx, gy = ghostState.configuration.halfPos
+                if abs(gx - px) + abs(gy - py) <= COLLISION_HALF_STEPS:
                     GhostRules.collide(state, ghostState, index)
         else:
             ghostState = state.data.agentStates[agentIndex]
-            ghostPosition = ghostState.configuration.getPosition()
-            if GhostRules.canKill(pacmanPosition, ghostPosition):
+            gx, gy = ghostState.configuration.halfPos
+            if abs(gx - px) + abs(gy - py) <= COLLISION_HALF_STEPS:
                 GhostRules.collide(state, ghostState, agentIndex)
 
     checkDeath = staticmethod(checkDeath)
 
     def collide(state, ghostState, agentIndex):
         if ghostState.scaredTimer > 0:
+            state.saveAgents()
+            ghostState = state.data.getMutableAgentState(agentIndex)
             state.data.scoreChange += 200
             GhostRules.placeGhost(state, ghostState)
             ghostState.scaredTimer = 0
             # Added for first-person
-            state.data._eaten[agentIndex] = True
+            eaten = list(state.data._eaten)
+            eaten[agentIndex] = True
+            state.data._eaten = eaten
         else:
             if not state.data._win:
                 state.data.scoreChange -= 500
@@ -486,11 +881,6 @@ class GhostRules:
 
     collide = staticmethod(collide)
 
-    def canKill(pacmanPosition, ghostPosition):
-        return manhattanDistance(ghostPosition, pacmanPosition) <= COLLISION_TOLERANCE
-
-    canKill = staticmethod(canKill)
-
     def placeGhost(state, ghostState):
         ghostState.configuration = ghostState.start
 
@@ -620,9 +1010,17 @@ def readCommand(argv):
     parser.add_option(
         "--replay",
         dest="gameToReplay",
-        help="A recorded game file (pickle) to replay",
+        help="A recorded game file (see recording.py) to replay",
         default=None,
     )
+    parser.add_option(
+        "--replayStart",
+        dest="replayStart",
+        type="int",
+        help=default("The move to start the replay from"),
+        metavar="MOVE",
+        default=0,
+    )
     parser.add_option(
         "-a",
         "--agentArgs",
@@ -661,6 +1059,30 @@ def readCommand(argv):
         ),
         default=30,
     )
+    parser.add_option(
+        "--batch",
+        dest="batchWorkers",
+        type="int",
+        help=default(
+            "Play the games headless in this many worker processes (0 plays them one by one)"
+        ),
+        metavar="WORKERS",
+        default=0,
+    )
+    parser.add_option(
+        "--seed",
+        dest="seed",
+        type="int",
+        help=default("Random seed of the first batch game; game i uses SEED + i"),
+        default=0,
+    )
+    parser.add_option(
+        "--results",
+        dest="resultsFile",
+        help="Appends one JSON line per batch game to this file",
+        metavar="FILE",
+        default=None,
+    )
 
     options, otherjunk = parser.parse_args(argv)
     if len(otherjunk) != 0:
@@ -699,7 +1121,7 @@ def readCommand(argv):
     args["ghosts"] = [ghostType(i + 1) for i in range(options.numGhosts)]
 
     # Choose a display format
-    if options.quietGraphics:
+    if options.quietGraphics or options.batchWorkers > 0:
         import textDisplay
 
         args["display"] = textDisplay.NullGraphics()
@@ -718,21 +1140,26 @@ def readCommand(argv):
     args["record"] = options.record
     args["catchExceptions"] = options.catchExceptions
     args["timeout"] = options.timeout
+    if options.fixRandomSeed:
+        args["seed"] = "cs188"
 
     # Special case: recorded games don't use the runGames method or args structure
     if options.gameToReplay != None:
         print("Replaying recorded game %s." % options.gameToReplay)
-        import pickle
+        import recording
 
-        f = open(options.gameToReplay)
-        try:
-            recorded = pickle.load(f)
-        finally:
-            f.close()
-        recorded["display"] = args["display"]
-        replayGame(**recorded)
+        recorded = recording.GameRecording.load(options.gameToReplay)
+        replayGame(recorded, args["display"], options.replayStart)
         sys.exit(0)
 
+    # Batch games are headless and use runBatch instead of runGames
+    if options.batchWorkers > 0:
+        for key in ["display", "numTraining"]:
+            args.pop(key, None)
+        args["workers"] = options.batchWorkers
+        args["seed"] = options.seed
+        args["resultsFile"] = options.resultsFile
+
     return args
 
 
@@ -763,27 +1190,29 @@ def loadAgent(pacman, nographics):
     raise Exception("The agent " + pacman + " is not specified in any *Agents.py.")
 
 
-def replayGame(layout, actions, display):
-    import pacmanAgents
-    import ghostAgents
-
+def replayGame(recording, display, startMove=0):
+    """
+    Plays back a GameRecording from move startMove, which is reached from the
+    nearest keyframe rather than by replaying the whole game.  Returns the
+    final state.
+    """
     rules = ClassicGameRules()
-    agents = [pacmanAgents.GreedyAgent()] + [
-        ghostAgents.RandomGhost(i + 1) for i in range(layout.getNumGhosts())
-    ]
-    game = rules.newGame(layout, agents[0], agents[1:], display)
-    state = game.state
+    rules.quiet = False
+    state = recording.stateAt(startMove)
+    game = Game([None] * recording.numAgents, display, rules)
+    game.state = state
     display.initialize(state.data)
 
-    for action in actions:
-        # Execute the action
-        state = state.generateSuccessor(*action)
+    for n in range(startMove, recording.numMoves):
+        # Execute the action; the recorded moves were checked when played
+        state = state.generateSuccessorUnchecked(*recording.getMove(n))
         # Change the display
         display.update(state.data)
         # Allow for game specific conditions (winning, losing, etc.)
         rules.process(state, game)
 
     display.finish()
+    return state
 
 
 def runGames(
@@ -796,6 +1225,7 @@ def runGames(
     numTraining=0,
     catchExceptions=False,
     timeout=30,
+    seed=None,
 ):
     import __main__
 
@@ -818,21 +1248,22 @@ def runGames(
         game = rules.newGame(
             layout, pacman, ghosts, gameDisplay, beQuiet, catchExceptions
         )
-        game.run()
-        if not beQuiet:
-            games.append(game)
-
         if record:
-            import time
-            import pickle
+            import recording
 
-            fname = ("recorded-game-%d" % (i + 1)) + "-".join(
+            fname = ("recorded-game-%d-" % (i + 1)) + "-".join(
                 [str(t) for t in time.localtime()[1:6]]
             )
-            f = file(fname, "w")
-            components = {"layout": layout, "actions": game.moveHistory}
-            pickle.dump(components, f)
-            f.close()
+            game.recorder = recording.GameRecorder(
+                fname + ".pmlog", game.state, layout.name, seed
+            )
+        try:
+            game.run()
+        finally:
+            if game.recorder is not None:
+                game.recorder.close()
+        if not beQuiet:
+            games.append(game)
 
     if (numGames - numTraining) > 0:
         scores = [game.state.getScore() for game in games]
@@ -846,6 +1277,144 @@ def runGames(
     return games
 
 
+def playBatchGame(
+    layout, pacman, ghosts, gameIndex, seed, timeout, catchExceptions, record=False
+):
+    """
+    Plays one headless game from a fixed seed and returns its result as a
+    dictionary.  Each call gets its own copy of the agents, so the result does
+    not depend on which games were played before it.  With record, the game
+    is saved as recorded-game-<game>-seed<seed>.pmlog.
+    """
+    import textDisplay
+
+    random.seed(seed)
+    rules = ClassicGameRules(timeout)
+    game = rules.newGame(
+        layout, pacman, ghosts, textDisplay.NullGraphics(), True, catchExceptions
+    )
+    if record:
+        import recording
+
+        game.recorder = recording.GameRecorder(
+            "recorded-game-%d-seed%d.pmlog" % (gameIndex + 1, seed),
+            game.state,
+            layout.name,
+            seed,
+        )
+    try:
+        game.run()
+    finally:
+        if game.recorder is not None:
+            game.recorder.close()
+    return {
+        "game": gameIndex,
+        "seed": seed,
+        "score": game.state.getScore(),
+        "win": game.state.isWin(),
+        "moves": len(game.moveHistory),
+        "agentTimes": game.totalAgentTimes,
+        "crashed": game.agentCrashed,
+    }
+
+
+def meanAndInterval(values, z=1.96):
+    """
+    Returns the mean of values and the half width of its (by default 95%)
+    normal confidence interval.  With no values, the mean is NaN.
+    """
+    n = len(values)
+    if n == 0:
+        return float("nan"), float("inf")
+    mean = sum(values) / float(n)
+    if n < 2:
+        return mean, float("inf")
+    variance = sum([(v - mean) ** 2 for v in values]) / (n - 1)
+    return mean, z * (variance / n) ** 0.5
+
+
+def runBatch(
+    layout,
+    pacman,
+    ghosts,
+    numGames,
+    workers,
+    seed=0,
+    resultsFile=None,
+    catchExceptions=False,
+    timeout=30,
+    record=False,
+):
+    """
+    Plays numGames headless games spread over a pool of worker processes.
+    Game i is played from random seed seed + i by fresh copies of the agents,
+    so a batch gives the same results whatever the number of workers.
+
+    Results are appended to resultsFile (one JSON object per line) as the
+    games finish, and a summary is printed at the end.  Returns the results
+    ordered by game.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import json
+
+    start = time.time()
+    results = []
+    out = open(resultsFile, "a") if resultsFile else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    playBatchGame,
+                    layout,
+                    pacman,
+                    ghosts,
+                    i,
+                    seed + i,
+                    timeout,
+                    catchExceptions,
+                    record,
+                )
+                for i in range(numGames)
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if out:
+                    out.write(json.dumps(result) + "\n")
+                    out.flush()
+    finally:
+        if out:
+            out.close()
+    elapsed = time.time() - start
+    if len(results) == 0:
+        print("Games:         0")
+        return results
+
+    results.sort(key=lambda result: result["game"])
+    scores = [result["score"] for result in results]
+    wins = [float(result["win"]) for result in results]
+    moves = sum([result["moves"] for result in results])
+    meanScore, scoreInterval = meanAndInterval(scores)
+    winRate, winInterval = meanAndInterval(wins)
+    print(
+        "Games:         %d in %.1fs on %d workers (%.2f games/s, %.0f moves/s)"
+        % (len(results), elapsed, workers, len(results) / elapsed, moves / elapsed)
+    )
+    print("Average Score: %.1f +/- %.1f (95%% confidence)" % (meanScore, scoreInterval))
+    print(
+        "Win Rate:      %d/%d (%.2f +/- %.2f)"
+        % (wins.count(1.0), len(wins), winRate, winInterval)
+    )
+    for agentIndex in range(len(results[0]["agentTimes"])):
+        agentTimes = [result["agentTimes"][agentIndex] for result in results]
+        meanTime, timeInterval = meanAndInterval(agentTimes)
+        print(
+            "Agent %d time:  %.2fs +/- %.2fs per game"
+            % (agentIndex, meanTime, timeInterval)
+        )
+    return results
+
+
 if __name__ == "__main__":
     """
     The main function called when pacman.py is run
@@ -858,7 +1427,10 @@ if __name__ == "__main__":
     > python pacman.py --help
     """
     args = readCommand(sys.argv[1:])  # Get game components based on input
-    runGames(**args)
+    if "workers" in args:
+        runBatch(**args)
+    else:
+        runGames(**args)
 
     # import cProfile
     # cProfile.run("runGames( **args )")
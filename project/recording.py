@@ -0,0 +1,167 @@
+# recording.py
+# ------------
+# Compact game recordings with keyframes, for recording every game and
+# replaying any part of one quickly.
+
+"""
+A recording is an append-only binary file:
+
+  header     magic, version, keyframe interval, layout content hash, number
+             of agents, then the layout name and the random seed as short
+             length-prefixed strings
+  records    one byte per move, (agentIndex << 3) | direction code, and
+             every `keyframe interval` moves (and before the first) a
+             KEYFRAME byte followed by a GameState snapshot (see
+             GameState.toBytes)
+
+so a game costs one byte per move plus a ~100 byte snapshot per keyframe,
+and any move can be reached from the keyframe before it.
+"""
+
+from game import Directions
+from pacman import GameState
+import layout
+import struct
+
+RECORDING_MAGIC = b"PMLOG"
+RECORDING_VERSION = 1
+KEYFRAME = 0x07
+DEFAULT_KEYFRAME_INTERVAL = 100
+
+_HEADER = struct.Struct("<5sBH20sB")
+_DIRECTIONS = [
+    Directions.NORTH,
+    Directions.SOUTH,
+    Directions.EAST,
+    Directions.WEST,
+    Directions.STOP,
+]
+_DIRECTION_CODES = dict([(d, i) for i, d in enumerate(_DIRECTIONS)])
+
+
+class GameRecorder:
+    """
+    Writes a recording as the game is played: Game.run calls recordMove
+    after every move when the recorder is its `recorder`.
+    """
+
+    def __init__(
+        self,
+        path,
+        state,
+        layoutName=None,
+        seed=None,
+        keyframeInterval=DEFAULT_KEYFRAME_INTERVAL,
+    ):
+        self.file = open(path, "wb")
+        self.keyframeInterval = keyframeInterval
+        self.numMoves = 0
+        header = _HEADER.pack(
+            RECORDING_MAGIC,
+            RECORDING_VERSION,
+            keyframeInterval,
+            state.data.layout.contentHash,
+            state.getNumAgents(),
+        )
+        self.file.write(header)
+        for text in [layoutName, seed]:
+            encoded = ("" if text is None else str(text)).encode()[:255]
+            self.file.write(bytes((len(encoded),)) + encoded)
+        self.writeKeyframe(state)
+
+    def writeKeyframe(self, state):
+        self.file.write(bytes((KEYFRAME,)) + state.toBytes())
+
+    def recordMove(self, agentIndex, action, state):
+        "Appends a move, and a keyframe of the state after it when one is due"
+        self.file.write(bytes(((agentIndex << 3) | _DIRECTION_CODES[action],)))
+        self.numMoves += 1
+        if self.numMoves % self.keyframeInterval == 0:
+            self.writeKeyframe(state)
+
+    def close(self):
+        self.file.close()
+
+
+class GameRecording:
+    """
+    A recording read back into memory.  Opening it scans the records once;
+    after that stateAt(n) decodes the nearest keyframe at or before move n
+    and replays at most `keyframeInterval - 1` moves from there.
+    """
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        magic, version, interval, contentHash, numAgents = _HEADER.unpack_from(view, 0)
+        if magic != RECORDING_MAGIC:
+            raise Exception("Not a game recording")
+        if version != RECORDING_VERSION:
+            raise Exception("Unsupported recording version %d" % version)
+        offset = _HEADER.size
+        strings = []
+        for i in range(2):
+            length = view[offset]
+            strings.append(bytes(view[offset + 1 : offset + 1 + length]).decode())
+            offset += 1 + length
+        self.keyframeInterval = interval
+        self.numAgents = numAgents
+        self.layoutName = strings[0] or None
+        self.seed = strings[1] or None
+        self.layout = self._findLayout(contentHash)
+
+        # Index the records: the move bytes, and where each keyframe starts
+        self._view = view
+        moves = bytearray()
+        self._keyframes = []
+        while offset < len(view):
+            code = view[offset]
+            if code == KEYFRAME:
+                self._keyframes.append(offset + 1)
+                offset += 1 + GameState.snapshotLength(view, offset + 1)
+            else:
+                moves.append(code)
+                offset += 1
+        self._moves = bytes(moves)
+        self.numMoves = len(self._moves)
+
+    def _findLayout(self, contentHash):
+        found = layout.getLayoutByHash(contentHash)
+        if found is None and self.layoutName is not None:
+            found = layout.getLayout(self.layoutName)
+            if found is not None and found.contentHash != contentHash:
+                raise Exception(
+                    "Layout %s has changed since it was recorded" % self.layoutName
+                )
+        if found is None:
+            raise Exception("Cannot find the layout this game was recorded on")
+        return found
+
+    def load(path):
+        f = open(path, "rb")
+        try:
+            return GameRecording(f.read())
+        finally:
+            f.close()
+
+    load = staticmethod(load)
+
+    def getMove(self, n):
+        "Returns move n (counting from 0) as (agentIndex, action)"
+        code = self._moves[n]
+        return code >> 3, _DIRECTIONS[code & 7]
+
+    def getMoves(self):
+        return [self.getMove(n) for n in range(self.numMoves)]
+
+    def stateAt(self, n):
+        """
+        Returns the state after the first n moves (0 is the starting state).
+        """
+        if not 0 <= n <= self.numMoves:
+            raise IndexError("move %d is not in this recording" % n)
+        keyframe = min(n // self.keyframeInterval, len(self._keyframes) - 1)
+        state = GameState.fromBytes(self._view, self._keyframes[keyframe], self.layout)
+        for move in range(keyframe * self.keyframeInterval, n):
+            agentIndex, action = self.getMove(move)
+            state = state.generateSuccessorUnchecked(agentIndex, action)
+        return state
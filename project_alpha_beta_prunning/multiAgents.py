@@ -12,9 +12,7 @@
 # Pieter Abbeel (pabbeel@cs.berkeley.edu).
 
 
-from util import manhattanDistance
 from game import Directions
-import random, util
 
 from game import Agent
 from pacman import GameState
@@ -39,7 +37,7 @@ def EvaluationFunction(currentGameState: GameState):
     score = currentGameState.getScore()
 
     # Evaluate the distance to the closest food
-    distancesToFoodList = [util.manhattanDistance(newPos, foodPos) for foodPos in newFood.asList()]
+    distancesToFoodList = [currentGameState.getMazeDistance(newPos, foodPos) for foodPos in newFood.asList()]
     if len(distancesToFoodList) > 0:
         score += WEIGHT_FOOD / min(distancesToFoodList)
     else:
@@ -47,7 +45,7 @@ def EvaluationFunction(currentGameState: GameState):
 
     # Evaluate the distance to ghosts
     for ghost in newGhostStates:
-        distance = manhattanDistance(newPos, ghost.getPosition())
+        distance = currentGameState.getMazeDistance(newPos, ghost.getPosition())
         if distance > 0:
             if ghost.scaredTimer > 0:  # If scared, add points
                 score += WEIGHT_SCARED_GHOST / distance